@@ -4,6 +4,15 @@ from tornado.ioloop import IOLoop
 
 @asynchronous
 def invoke(handler, params):
+  if 'since' in params:
+    # Clients that pass the "since" value from their last response receive any messages they missed between polls
+    def receive_messages(messages):
+      if messages is None:
+        handler.respond(result={'messages': None, 'since': handler.event_manager.instance().sequence()})
+      else:
+        handler.respond(result={'messages': [m[1] for m in messages], 'since': messages[-1][0]})
+    handler.register_event_handler('message', receive_messages, deregister_on_finish=True, since=int(params['since']))
+    return
   def receive_message(message):
     handler.respond(result={'message': message})
   handler.register_event_handler('message', receive_message, deregister_on_finish=True)
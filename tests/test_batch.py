@@ -0,0 +1,99 @@
+import unittest
+from tornado.ioloop import IOLoop
+from toto.handler import TotoHandler
+from toto.invocation import authenticated, authenticated_with_parameter
+from toto.futures import Future, then
+from toto.profiling import NULL_TIMER
+
+class Request(object):
+
+  def __init__(self, headers=None):
+    self.headers = headers or {}
+    self.body = ''
+
+class Session(object):
+
+  def __init__(self, session_id):
+    self.session_id = session_id
+    self.user_id = 'user-' + session_id
+
+class AsyncSessions(object):
+  '''A database connection that resolves session lookups only when ``resolve()`` is called.'''
+
+  def __init__(self):
+    self.lookups = []
+
+  def retrieve_session(self, session_id, hmac_data=None, data=None):
+    future = Future()
+    self.lookups.append((session_id, future))
+    return future
+
+  def resolve(self):
+    for session_id, future in self.lookups:
+      future.set_result(Session(session_id))
+
+class BatchHandler(TotoHandler):
+  '''A handler that runs batches without a connection. Each request's "result" parameter is returned synchronously
+  unless the request names one of the handler's ``methods``.'''
+
+  def __init__(self, methods=None, headers=None):
+    self.timer = NULL_TIMER
+    self.request = Request(headers)
+    self.db_connection = AsyncSessions()
+    self.session = None
+    self._finished = False
+    self.methods = methods or {}
+    self.responses = []
+
+  def add_header(self, name, value):
+    pass
+
+  def invoke_method(self, path, request_body, parameters, finish_by_default=True, handler=None):
+    if request_body.get('method') in self.methods:
+      return (self.methods[request_body['method']](handler, parameters), None, finish_by_default)
+    return (parameters['result'], None, finish_by_default)
+
+  def respond(self, result=None, error=None, batch_results=None):
+    self.responses.append(batch_results)
+    self._finished = True
+
+def run_callbacks():
+  io_loop = IOLoop.instance()
+  for i in xrange(3):
+    io_loop.add_callback(io_loop.stop)
+    io_loop.start()
+
+class TestBatch(unittest.TestCase):
+
+  def test_empty_batch(self):
+    handler = BatchHandler()
+    handler.batch_process_request({})
+    self.assertEqual(handler.responses, [{}])
+
+  def test_synchronous_batch(self):
+    handler = BatchHandler()
+    handler.batch_process_request({'a': {'method': 'a', 'parameters': {'result': 1}}, 'b': {'method': 'b', 'parameters': {'result': 2}}})
+    self.assertEqual(handler.responses, [{'a': {'result': 1}, 'b': {'result': 2}}])
+
+  def test_item_sessions(self):
+    # Both lookups finish before either method reads its session
+    gate = Future()
+    user = authenticated_with_parameter(lambda handler, parameters: then(gate, lambda value: handler.session.user_id))
+    handler = BatchHandler({'user': user})
+    handler.batch_process_request({'a': {'method': 'user', 'parameters': {'session_id': 'x'}}, 'b': {'method': 'user', 'parameters': {'session_id': 'y'}}})
+    handler.db_connection.resolve()
+    gate.set_result(None)
+    run_callbacks()
+    self.assertEqual(handler.responses, [{'a': {'result': 'user-x'}, 'b': {'result': 'user-y'}}])
+
+  def test_shared_header_session(self):
+    user = authenticated(lambda handler, parameters: handler.session.user_id)
+    handler = BatchHandler({'user': user}, {'x-toto-session-id': 'h'})
+    handler.batch_process_request({'a': {'method': 'user', 'parameters': {}}, 'b': {'method': 'user', 'parameters': {}}})
+    handler.db_connection.resolve()
+    run_callbacks()
+    self.assertEqual([lookup[0] for lookup in handler.db_connection.lookups], ['h'])
+    self.assertEqual(handler.responses, [{'a': {'result': 'user-h'}, 'b': {'result': 'user-h'}}])
+
+if __name__ == '__main__':
+  unittest.main()
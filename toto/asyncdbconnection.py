@@ -0,0 +1,55 @@
+'''``AsyncDBConnection`` wraps any blocking ``DBConnection`` so that the session methods used on every
+request no longer block Tornado's ``IOLoop``. Session lookups run on a ``toto.tasks.TaskQueue`` and return
+``toto.futures.Future`` instances whose callbacks run on the ``IOLoop``.
+
+Toto's session decorators (``@authenticated`` etc.) and ``TotoHandler`` understand these futures, so methods
+work unchanged with either kind of connection. Enable it for the configured database with the
+``async_db_threads`` option. The wrapped driver must be safe to use from multiple threads (the Postgres,
+Redis and MongoDB drivers are); use a single thread with ``tornado.database`` (MySQL).
+'''
+
+from toto.dbconnection import DBConnection
+from toto.tasks import TaskQueue
+from tornado.ioloop import IOLoop
+
+class AsyncDBConnection(DBConnection):
+  '''Runs ``create_session`` and ``retrieve_session`` of ``connection`` on ``thread_count`` threads,
+  returning futures that resolve on ``io_loop`` (``IOLoop.instance()`` by default). Sessions returned by
+  this connection also return a future from ``save()``. Account methods are passed directly to
+  ``connection``.
+  '''
+
+  asynchronous = True
+
+  def __init__(self, connection, thread_count=4, io_loop=None):
+    self.connection = connection
+    self.db = connection.db
+    self.io_loop = io_loop or IOLoop.instance()
+    self.task_queue = TaskQueue(thread_count, self.io_loop)
+
+  def __async_session(self, session):
+    if session:
+      save = session.save
+      session.save = lambda: self.task_queue.submit(save)
+    return session
+
+  def create_account(self, user_id, password, additional_values={}, **values):
+    return self.connection.create_account(user_id, password, additional_values, **values)
+
+  def create_session(self, user_id=None, password=None):
+    return self.task_queue.submit(lambda: self.__async_session(self.connection.create_session(user_id, password)))
+
+  def retrieve_session(self, session_id, hmac_data=None, data=None):
+    return self.task_queue.submit(lambda: self.__async_session(self.connection.retrieve_session(session_id, hmac_data, data)))
+
+  def remove_session(self, session_id):
+    return self.connection.remove_session(session_id)
+
+  def clear_sessions(self, user_id):
+    return self.connection.clear_sessions(user_id)
+
+  def change_password(self, user_id, password, new_password):
+    return self.connection.change_password(user_id, password, new_password)
+
+  def generate_password(self, user_id):
+    return self.connection.generate_password(user_id)
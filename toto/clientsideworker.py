@@ -1,9 +1,9 @@
 from tornado.web import *
-import json
 from invocation import *
 from exceptions import *
 from tornado.options import define, options
 from events import EventManager
+from serialization import get_codec
 from tornado.websocket import WebSocketHandler
 import logging
 from collections import deque
@@ -28,7 +28,8 @@ class ClientSideWorkerManager(object):
     while self.__operation_queue and self.__worker_queue:
       operation = self.__operation_queue.popleft()
       worker_id = self.__worker_queue.popleft()
-      self.__workers[worker_id].write_message({'operation_id': operation[0], 'script': operation[1]})
+      worker = self.__workers[worker_id]
+      worker.write_message(worker.codec.dumps({'operation_id': operation[0], 'script': operation[1]}), worker.codec.binary)
       if (operation[2]):
         self.__operation_queue.append(operation)
 
@@ -64,8 +65,11 @@ def complete(worker, data):
 
 class ClientSideWorkerSocketHandler(WebSocketHandler):
 
+  codec = get_codec('json')
+
   @classmethod
   def configure(cls):
+    cls.codec = get_codec(options.socket_serialization)
     if options.debug:
       import traceback
       def log_error(self, e): 
@@ -82,7 +86,7 @@ class ClientSideWorkerSocketHandler(WebSocketHandler):
     ClientSideWorkerManager.instance().add_worker(self)
 
   def on_message(self, message_data):
-    message = json.loads(message_data)
+    message = self.codec.loads(message_data)
     ClientSideWorkerManager.instance().finish_operation(self, message['operation_id'], message['result'])
 
   def on_close(self):
@@ -1,3 +1,8 @@
+from threading import Lock
+from time import time
+from traceback import format_exc
+import logging
+
 class DBConnection(object):
   '''Toto uses subclasses of DBConnection to support session and account storage as well as general
     access to the backing database. Usually, direct access to the underlying database driver will
@@ -58,6 +63,81 @@ class DBConnection(object):
     '''
     raise NotImplementedError()
 
+  def enable_session_cache(self, size=1000, ttl=5, event_manager=None):
+    '''Cache up to ``size`` sessions in this process for ``ttl`` seconds to avoid a database round trip
+    on every call to ``retrieve_session``. Pass an ``EventManager`` as ``event_manager`` to broadcast
+    cache invalidations to other servers. See ``toto.sessioncache.SessionCache`` for details.
+    '''
+    from sessioncache import SessionCache
+    self.session_cache = SessionCache(self, size, ttl, event_manager)
+    return self.session_cache
+
+  session_renewals = None
+
+  def enable_session_renewal_batching(self, interval=1):
+    '''Collect session expiry renewals made by ``retrieve_session`` and write them to the database
+    in a single bulk operation at most once every ``interval`` seconds instead of once per request.
+    Pending renewals are written by the first ``retrieve_session`` call after ``interval`` has
+    elapsed, or explicitly by calling ``session_renewals.flush()``.
+    '''
+    self.session_renewals = SessionRenewalQueue(self._renew_sessions, interval)
+    return self.session_renewals
+
+  def _renew_session(self, session_id, ttl):
+    '''Subclasses call this method to extend the session matching ``session_id`` by ``ttl`` seconds.
+    '''
+    if self.session_renewals is not None:
+      self.session_renewals.add(session_id, ttl)
+    else:
+      self._renew_sessions({ttl: [session_id]})
+
+  def _renew_sessions(self, renewals):
+    '''Subclasses implement this method to set the expiry of every session in ``renewals`` (a dictionary
+    mapping ttl to a list of session ids) to ``ttl`` seconds from now, ideally in one bulk operation.
+    '''
+    raise NotImplementedError()
+
+class SessionRenewalQueue(object):
+  '''Coalesces session renewals so they can be written in bulk. ``flush_function`` will be called with
+  a dictionary mapping each ttl to the list of session ids to renew. Repeated renewals of the same
+  session between flushes are written once.
+  '''
+
+  def __init__(self, flush_function, interval=1):
+    self.interval = interval
+    self.__flush_function = flush_function
+    self.__renewals = {}
+    self.__lock = Lock()
+    self.__next_flush = time() + interval
+
+  def __len__(self):
+    return len(self.__renewals)
+
+  def add(self, session_id, ttl):
+    '''Queue the session matching ``session_id`` to be renewed for ``ttl`` seconds. Queued renewals
+    will be flushed if ``interval`` seconds have passed since the last flush.
+    '''
+    with self.__lock:
+      self.__renewals[session_id] = ttl
+    if time() >= self.__next_flush:
+      self.flush()
+
+  def flush(self):
+    '''Write all queued renewals to the database.
+    '''
+    with self.__lock:
+      renewals, self.__renewals = self.__renewals, {}
+      self.__next_flush = time() + self.interval
+    if not renewals:
+      return
+    grouped = {}
+    for session_id, ttl in renewals.iteritems():
+      grouped.setdefault(ttl, []).append(session_id)
+    try:
+      self.__flush_function(grouped)
+    except Exception as e:
+      logging.error(format_exc())
+
 from tornado.options import define, options
 
 define("database", metavar='mysql|mongodb|redis|postgres|none', default="none", help="the database driver to use")
@@ -78,8 +158,31 @@ define("session_ttl", default=24*60*60*365, help="The number of seconds after cr
 define("anon_session_ttl", default=24*60*60, help="The number of seconds after creation an anonymous session should expire")
 define("session_renew", default=0, help="The number of seconds before a session expires that it should be renewed, or zero to renew on every request")
 define("anon_session_renew", default=0, help="The number of seconds before an anonymous session expires that it should be renewed, or zero to renew on every request")
+define("session_renew_interval", default=0, help="If set, session expiry renewals are collected and written to the database in bulk at most once every session_renew_interval seconds instead of on every request")
+define("async_db_threads", default=0, help="If set, session lookups will run on this many threads and return futures instead of blocking the IOLoop. The database driver must be thread safe")
+define("session_cache_size", default=0, help="The maximum number of sessions to cache in each process, or zero to disable the session cache")
+define("session_cache_ttl", default=5, help="The number of seconds a session may be served from the session cache before it is reloaded from the database")
+define("session_state_serialization", default='cPickle', help="The codec (see toto.serialization) or module used to serialize session state. Changing this will make existing session state unreadable")
+
+def configured_connection():
+    connection = _configured_connection()
+    from session import TotoSession
+    from serialization import get_codec
+    TotoSession.state_codec = get_codec(options.session_state_serialization)
+    if options.session_renew_interval:
+      connection.enable_session_renewal_batching(options.session_renew_interval)
+    if options.session_cache_size:
+      event_manager = None
+      if getattr(options, 'event_mode', 'off') != 'off' or getattr(options, 'remote_event_receivers', None):
+        from events import EventManager
+        event_manager = EventManager.instance()
+      connection.enable_session_cache(options.session_cache_size, options.session_cache_ttl, event_manager)
+    if options.async_db_threads:
+      from asyncdbconnection import AsyncDBConnection
+      connection = AsyncDBConnection(connection, options.async_db_threads)
+    return connection
 
-def configured_connection():  
+def _configured_connection():  
     if options.database == "mongodb":
       from mongodbconnection import MongoDBConnection
       return MongoDBConnection(options.db_host, options.db_port or 27017, options.mongodb_database, options.session_ttl, options.anon_session_ttl, options.session_renew, options.anon_session_renew)
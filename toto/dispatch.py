@@ -0,0 +1,74 @@
+'''``toto.dispatch`` resolves method names to method modules. Instead of walking the method module with
+``getattr`` on every request, a ``DispatchTable`` scans the method module once and stores every callable
+method under both its dotted name (``a.b.c``) and its URL path (``a/b/c``).
+'''
+
+from toto.exceptions import *
+from types import ModuleType
+
+class DispatchTable(object):
+  '''Instances map method names under ``root`` (a method module) to ``(module, invoke, asynchronous)``
+  tuples. ``module`` is the method module itself, ``invoke`` is its (fully decorated) invoke function and
+  ``asynchronous`` is ``True`` if ``invoke`` was marked with ``@asynchronous``.
+
+  Submodules of ``root`` are included if they are imported by their parent package, matching the modules
+  that were reachable by name before the table was introduced. Modules imported under an alias (e.g.
+  ``import toto.methods.account.create as account_create``) are included if they define ``invoke`` or are
+  themselves sub-packages.
+  '''
+
+  def __init__(self, root=None):
+    self.root = root
+    self.__methods = {}
+    if root:
+      self.refresh()
+
+  def refresh(self):
+    '''Rebuild the table by scanning ``root``. Call this if method modules are added to the method module
+    after the table was created.
+    '''
+    self.__methods.clear()
+    self.__scan(self.root, [], set())
+
+  def __scan(self, module, path, visited):
+    visited.add(id(module))
+    for name, value in module.__dict__.items():
+      if name.startswith('_') or not isinstance(value, ModuleType) or id(value) in visited:
+        continue
+      if not (value.__name__.startswith(module.__name__ + '.') or hasattr(value, 'invoke') or (hasattr(value, '__path__') and '.' in value.__name__)):
+        continue
+      method_path = path + [name]
+      if hasattr(value, 'invoke'):
+        self.add(method_path, value)
+      self.__scan(value, method_path, visited)
+    visited.discard(id(module))
+
+  def add(self, path, module):
+    '''Register ``module`` under ``path``, a list of name components. The method will be available as
+    ``'.'.join(path)`` and ``'/'.join(path)``.
+    '''
+    invoke = module.invoke
+    entry = (module, invoke, hasattr(invoke, 'asynchronous'))
+    self.__methods['.'.join(path)] = entry
+    self.__methods['/'.join(path)] = entry
+
+  def get(self, name):
+    '''Return the ``(module, invoke, asynchronous)`` tuple registered for ``name``. ``name`` may be a dotted
+    method name or a URL path. A ``TotoException`` with ``ERROR_MISSING_METHOD`` will be raised if no method
+    matches ``name``.
+    '''
+    try:
+      return self.__methods[name]
+    except KeyError:
+      raise TotoException(ERROR_MISSING_METHOD, "Missing method: %s" % name)
+
+  def __contains__(self, name):
+    return name in self.__methods
+
+  def __len__(self):
+    return len(self.__methods)
+
+  def names(self):
+    '''Returns the dotted names of all registered methods.
+    '''
+    return [k for k in self.__methods if '/' not in k]
@@ -1,32 +1,200 @@
 '''Toto's event framework is used to allow external events to affect client requests, or to run scheduled tasks
 after a specified signal is received. It can be used to send messages to active requests, even between multiple
 server processes. The event framework can also be used outside of Toto to send messages to running Toto servers.
+
+Each event is sent with its name in a separate message frame so servers can discard events they have no handlers
+for without decompressing them. Listening servers also advertise the event names they have handlers for to every
+server they have registered, and senders only deliver events to servers that have advertised a matching handler.
+Servers that have not advertised their handlers (e.g. processes that only send events) receive every event.
+
+With the ``event_transport`` option set to "pubsub", broadcast events are instead published once to an event broker
+(see ``EventManager.start_broker()``) at ``event_publish_address``. Listening servers subscribe to the event names
+they have handlers for at ``event_subscribe_address`` and the broker only forwards matching events, so servers do not
+need to be registered with every sender. Non-broadcast events and ``send_to_server()`` still use servers registered with
+``register_server()``. As with any ZMQ PUB/SUB socket, events published before a new subscription reaches the broker
+are not delivered.
+
+Set the ``event_batch_size`` option to batch events under load. An event is sent immediately if nothing has been sent
+to its destination for ``event_batch_delay`` milliseconds, otherwise it is queued until ``event_batch_size`` events are
+waiting for that destination or the delay expires. Each batch is serialized and compressed once. Payloads smaller than
+``event_compression_threshold`` bytes are never compressed.
+
+Handlers may be registered for an exact event name or for a prefix by ending the name with "*". For example,
+"chat.*" matches "chat.lobby" and "chat.room.1" and "*" matches every event.
+
+Every event received by a listening server is given a sequence number that increases with each event. Set the
+``event_backlog_size`` option to keep that many of the most recent events for each subscribed event name. A handler
+registered with ``since`` set to the last sequence number it saw is called immediately with the events it missed,
+so long poll clients do not lose events that arrive between polls. Sequence numbers are only meaningful to the server
+that assigned them.
+
+Non-broadcast events sent with a ``key`` are routed by consistent hashing, so every event with the same key reaches
+the same server while the set of registered servers is unchanged. Registering or removing a server only remaps the
+keys on that server's part of the hash ring.
+
+Registrations only hold weak references to their ``request_handler``, and registrations for request handlers that
+have finished, closed their connection or been garbage collected are removed every ``event_sweep_interval`` seconds
+rather than waiting for the event to fire. Register with ``weak=True`` to also hold the event handler weakly.
+
+``EventManager.stats()`` reports how many events were sent, received, dispatched and skipped for each event name along
+with the time events take to reach the receiving server and the main ``IOLoop``, so slow event delivery can be traced
+to the sender, the transport or the ``IOLoop``.
 '''
 
-import cPickle as pickle
-from threading import Thread
+from threading import Thread, Lock, Condition
 from collections import deque
 from tornado.web import *
 from tornado.ioloop import IOLoop
 from traceback import format_exc
-from tornado.options import options
+from tornado.options import define, options
+from toto.serialization import get_codec
+from toto.profiling import Histogram
+from time import time
+import socket as sockets
 import zmq
 import logging
 import zlib
+import weakref
 from random import choice, shuffle
+from bisect import bisect
+from hashlib import md5
+
+define("event_serialization", default='pickle', help="The codec (see toto.serialization) used to serialize events. All servers and clients must use the same codec")
+define("event_transport", default='push', metavar='push|pubsub', help="Selects whether broadcast events are pushed to each registered server or published through an event broker")
+define("event_publish_address", default='tcp://127.0.0.1:8997', help="With event_transport=pubsub, broadcast events are published to the event broker at this address")
+define("event_subscribe_address", default='tcp://127.0.0.1:8998', help="With event_transport=pubsub, listening servers receive events from the event broker at this address")
+define("event_batch_size", default=0, help="The maximum number of events to send to a destination in a single message, or zero to send every event immediately")
+define("event_batch_delay", default=5, help="The maximum number of milliseconds an event may wait to be batched with other events")
+define("event_compression_threshold", default=512, help="Serialized events (or batches) smaller than this many bytes will not be compressed")
+define("event_dispatch_slice", default=10, help="The maximum number of milliseconds the main IOLoop will spend running handlers for an event before yielding to other callbacks")
+define("event_backlog_size", default=0, help="The number of recent events to keep for each subscribed event name so handlers can be registered with since=<sequence>, or zero to disable")
+define("event_sweep_interval", default=10, help="The number of seconds between removing handlers registered for finished requests")
+define("event_overflow_size", default=10000, help="The number of events held for a server whose queue has reached the ZMQ high water mark while they are retried in the background. The oldest events are dropped when a server's overflow is full")
+define("event_topic_ttl", default=60, help="The number of seconds an event name stays advertised to other servers after its last handler is removed. Long poll clients re-register handlers after every event, so this should be longer than the time between polls")
+
+class TopicSet(object):
+  '''A set of event names and prefix patterns. Topics ending with "*" match every event name that starts with the rest
+  of the topic.
+  '''
+
+  def __init__(self, topics=()):
+    self.names = set()
+    self.prefixes = set()
+    for topic in topics:
+      self.add(topic)
+
+  def add(self, topic):
+    if topic.endswith('*'):
+      self.prefixes.add(topic[:-1])
+    else:
+      self.names.add(topic)
+
+  def matches(self, event_name):
+    '''Returns ``True`` if ``event_name`` matches any topic in the set.
+    '''
+    if event_name in self.names:
+      return True
+    for prefix in self.prefixes:
+      if event_name.startswith(prefix):
+        return True
+    return False
+
+  def topics(self):
+    return list(self.names) + [prefix + '*' for prefix in self.prefixes]
+
+class WeakHandler(object):
+  '''Calls ``callback`` without keeping it alive. Bound methods are called for as long as their instance exists, other
+  callables must be referenced elsewhere. Calls are ignored once ``callback`` has been garbage collected.
+  '''
+
+  def __init__(self, callback):
+    if getattr(callback, 'im_self', None) is not None:
+      self.__ref = weakref.ref(callback.im_self)
+      self.__function = callback.im_func
+    else:
+      self.__ref = weakref.ref(callback)
+      self.__function = None
+
+  def alive(self):
+    return self.__ref() is not None
+
+  def __call__(self, *args):
+    target = self.__ref()
+    if target is None:
+      return
+    if self.__function:
+      return self.__function(target, *args)
+    return target(*args)
 
 class EventManager():
-  '''Instances will listen on ``address`` for incoming events.
+  '''Instances will listen on ``address`` for incoming events. Events are serialized with the ``toto.serialization``
+  codec named ``serialization`` (the ``event_serialization`` option by default). ``transport``, ``publish_address``
+  and ``subscribe_address`` default to the ``event_transport``, ``event_publish_address`` and ``event_subscribe_address``
+  options. ``batch_size``, ``batch_delay`` and ``compression_threshold`` are set from the ``event_batch_size``,
+  ``event_batch_delay`` and ``event_compression_threshold`` options and may be changed at any time. ``backlog_size`` is
+  set from the ``event_backlog_size`` option.
+
+  Other servers learn which events this instance handles through the addresses returned by ``aliases()``. If other
+  servers reach this one through an address that cannot be derived from ``address`` (e.g. through NAT), set
+  ``advertised_addresses`` to a list of those addresses.
   '''
 
-  def __init__(self, address=None):
+  TOPICS_EVENT = 'toto.events.topics'
+  BATCH_TOPIC = 'toto.events.batch'
+  MAINTENANCE_INTERVAL = 1.0
+  RING_REPLICAS = 160
+  OVERFLOW_RETRY = 0.01
+
+  def __init__(self, address=None, serialization=None, transport=None, publish_address=None, subscribe_address=None):
     self.__handlers = {}
+    self.__patterns = set()
+    self.__empty_since = {}
+    self.__handler_lock = Lock()
+    self.__sequence = int(time() * 1000)
+    self.__subscribed_since = {}
+    self.__backlogs = {}
+    self.__evicted = {}
+    self.backlog_size = options.event_backlog_size
+    self.__stats_lock = Lock()
+    self.__event_counts = {}
+    self.__ignored = 0
+    self.__hwm_hits = 0
+    self.__swept = 0
+    self.__receive_lag = Histogram()
+    self.__loop_lag = Histogram()
+    self.codec = get_codec(serialization or options.event_serialization)
     self.address = address
+    self.advertised_addresses = None
+    self.__hosts = None
     self.__zmq_context = zmq.Context()
     self.__remote_servers = {}
+    self.__server_topics = {}
+    self.__advertised = None
+    self.__send_lock = Lock()
+    self.transport = transport or options.event_transport
+    self.publish_address = publish_address or options.event_publish_address
+    self.subscribe_address = subscribe_address or options.event_subscribe_address
+    self.batch_size = options.event_batch_size
+    self.batch_delay = options.event_batch_delay
+    self.compression_threshold = options.event_compression_threshold
+    self.__batches = {}
+    self.__batch_deadlines = {}
+    self.__last_sent = {}
+    self.__batch_condition = Condition(self.__send_lock)
+    self.overflow_size = options.event_overflow_size
+    self.__overflow = {}
+    self.__dropped = 0
+    self.__batch_thread = None
+    self.__publisher = None
+    if self.transport == 'pubsub':
+      self.__publisher = self.__zmq_context.socket(zmq.PUB)
+      self.__publisher.connect(self.publish_address)
+    self.__control_address = 'inproc://toto.events.%s' % id(self)
+    self.__control = None
     self.__thread = None
     self.__queued_servers = deque()
-  
+    self.__ring = ([], [])
+
   def register_server(self, address):
     '''Add a server located at ``address``. This server will now be included in the
     recipient list whenever ``send()`` is called.
@@ -37,77 +205,653 @@ class EventManager():
     socket.connect(address)
     self.__remote_servers[address] = socket
     self.refresh_server_queue()
+    if self.__thread:
+      self.advertise(address)
 
   def remove_server(self, address):
     '''Remove the server located at ``address`` from the recipient list for all
     future calls to ``send()``.
     '''
-    del self.__remote_servers[address]
+    with self.__send_lock:
+      self.__discard_batch(self.__remote_servers.pop(address))
     self.refresh_server_queue()
-    
+
   def remove_all_servers(self):
     '''Clear the recipient list for all future calls to ``send``.
     '''
-    self.__remote_servers.clear()
+    with self.__send_lock:
+      for socket in self.__remote_servers.itervalues():
+        self.__discard_batch(socket)
+      self.__remote_servers.clear()
     self.refresh_server_queue()
 
   def refresh_server_queue(self):
     '''Reload and shuffle the registered server queue used for round-robin load
-    balancing of non-broadcast events.
+    balancing of non-broadcast events and rebuild the hash ring used for keyed events.
     '''
     self.__queued_servers.clear()
-    self.__queued_servers.extend(self.__remote_servers.itervalues())
+    self.__queued_servers.extend(self.__remote_servers.iteritems())
     shuffle(self.__queued_servers)
-  
-  def register_handler(self, event_name, event_handler, run_on_main_loop=False, request_handler=None, persist=False):
+    points = []
+    for address, socket in self.__remote_servers.iteritems():
+      for i in xrange(self.RING_REPLICAS):
+        points.append((self.__hash('%s#%d' % (address, i)), address, socket))
+    points.sort()
+    self.__ring = ([point[0] for point in points], [point[1:] for point in points])
+
+  @staticmethod
+  def __hash(key):
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    return int(md5(str(key)).hexdigest()[:16], 16)
+
+  def __server_for_key(self, key):
+    # The owner depends only on the ring. Servers that were removed before the ring was rebuilt are skipped
+    hashes, servers = self.__ring
+    if not hashes:
+      return None
+    start = bisect(hashes, self.__hash(key))
+    for i in xrange(start, start + len(servers)):
+      server = servers[i % len(servers)]
+      if self.__remote_servers.get(server[0]) is server[1]:
+        return server
+    return None
+
+  def server_for_key(self, key):
+    '''Returns the address of the registered server that events sent with ``key`` are routed to, or ``None`` if there are
+    no registered servers. The server only changes when servers are registered or removed, so it does not depend on
+    which topics the server has advertised.
+    '''
+    server = self.__server_for_key(key)
+    return server and server[0]
+
+  def register_handler(self, event_name, event_handler, run_on_main_loop=False, request_handler=None, persist=False, since=None, weak=False):
     '''Register ``event_handler`` to run when ``event_name`` is received. Handlers are meant to respond to
     a single event matching ``event_name`` only. If ``run_on_main_loop`` is ``True`` the handler will be executed
-    on Tornado's main ``IOLoop`` (required if the handler will write to a response stream). If ``request_handler``
-    is set, ``event_handler`` will not fire once ``request_handler`` has finished. Set ``persist`` to ``True``
-    to automatically requeue ``event_handler`` each time it is executed.
-    '''
-    if not event_name in self.__handlers:
-      self.__handlers[event_name] = set()
-    handler_tuple = (event_handler, run_on_main_loop, request_handler, persist)
-    self.__handlers[event_name].add(handler_tuple)
+    on Tornado's main ``IOLoop`` (required if the handler will write to a response stream). All of an event's main loop
+    handlers are run from a single ``IOLoop`` callback, yielding to other callbacks every ``event_dispatch_slice``
+    milliseconds. If ``request_handler`` is set, ``event_handler`` will not fire once ``request_handler`` has finished
+    or its connection has closed, and the registration is removed by the next ``sweep()``. Set ``persist`` to ``True``
+    to automatically requeue ``event_handler`` each time it is executed. If ``weak`` is ``True``, ``event_handler`` is
+    wrapped in a ``WeakHandler`` and the registration is removed once it has been garbage collected.
+
+    If ``event_name`` ends with "*", ``event_handler`` will run for every event that starts with the rest of ``event_name``.
+
+    If ``since`` is set, ``event_handler`` is called with a list of ``(sequence, event_args)`` tuples instead of
+    ``event_args``. Any events after sequence number ``since`` that are still in the backlog (see ``event_backlog_size``)
+    are passed to ``event_handler`` immediately, and if ``persist`` is ``False`` it is not registered for further events.
+    If events after ``since`` may have been missed (e.g. because the backlog is full or ``since`` was assigned by
+    another server), ``event_handler`` is called immediately with ``None`` instead and should reload any state that
+    depends on the events. ``sequence()`` returns the sequence number to use from that point.
+    '''
+    if weak:
+      event_handler = WeakHandler(event_handler)
+    if request_handler is not None:
+      request_handler = weakref.ref(request_handler)
+    handler_tuple = (event_handler, run_on_main_loop, request_handler, persist, since is not None)
+    events = []
+    with self.__handler_lock:
+      if not event_name in self.__handlers:
+        self.__handlers[event_name] = set()
+        self.__subscribed_since[event_name] = self.__sequence
+        if event_name.endswith('*'):
+          self.__patterns.add(event_name)
+      if since is not None:
+        events = self.__replay(event_name, since)
+      if persist or not (events or events is None):
+        self.__handlers[event_name].add(handler_tuple)
+        self.__empty_since.pop(event_name, None)
+      if run_on_main_loop and (events or events is None):
+        # Scheduled while holding the lock so the replay runs before any newer events
+        IOLoop.instance().add_callback(lambda: self.__run_handlers(event_name, [handler_tuple], None, events, 0))
+    if not run_on_main_loop and (events or events is None):
+      self.__run_handlers(event_name, [handler_tuple], None, events, 0)
+    if self.__thread and (self.__advertised is None or event_name not in self.__advertised):
+      self.__wake()
     return (event_name, handler_tuple)
 
+  def sweep(self):
+    '''Remove registrations whose request handler has finished, closed its connection or been garbage collected and
+    weak registrations whose event handler has been garbage collected. Returns the number of registrations removed.
+    This is called automatically every ``event_sweep_interval`` seconds by listening instances.
+    '''
+    removed = 0
+    with self.__handler_lock:
+      for handlers in self.__handlers.values():
+        for handler in list(handlers):
+          if self.__finished(handler) or (isinstance(handler[0], WeakHandler) and not handler[0].alive()):
+            handlers.discard(handler)
+            removed += 1
+    with self.__stats_lock:
+      self.__swept += removed
+    return removed
+
+  @staticmethod
+  def __finished(handler):
+    if handler[2] is None:
+      return False
+    request_handler = handler[2]()
+    if request_handler is None or request_handler._finished:
+      return True
+    stream = getattr(getattr(getattr(request_handler, 'request', None), 'connection', None), 'stream', None)
+    return stream is not None and stream.closed()
+
+  def sequence(self):
+    '''Returns the sequence number of the most recently received event.
+    '''
+    return self.__sequence
+
+  def __replay(self, topic, since):
+    # Returns the backlogged events for topic after since, or None if any may be missing
+    if since > self.__sequence or since < self.__subscribed_since.get(topic, self.__sequence):
+      return None
+    prefix = topic[:-1] if topic.endswith('*') else None
+    events = []
+    for event_name, backlog in self.__backlogs.iteritems():
+      if event_name == topic or (prefix is not None and event_name.startswith(prefix)):
+        if self.__evicted.get(event_name, 0) > since:
+          return None
+        events.extend(event for event in backlog if event[0] > since)
+    events.sort(key=lambda event: event[0])
+    return events
+
+  def __record(self, event_name, sequence, event_args):
+    backlog = self.__backlogs.get(event_name)
+    if backlog is None:
+      backlog = self.__backlogs[event_name] = deque()
+    backlog.append((sequence, event_args))
+    while len(backlog) > self.backlog_size:
+      self.__evicted[event_name] = backlog.popleft()[0]
+
   def remove_handler(self, handler_sig):
     '''Disable and remove the handler matching ``handler_sig``.
     '''
-    self.__handlers[handler_sig[0]].discard(handler_sig[1])
-  
+    handlers = self.__handlers.get(handler_sig[0])
+    if handlers:
+      handlers.discard(handler_sig[1])
+
+  def subscribed_topics(self):
+    '''Returns the list of event names and patterns that have handlers, or had handlers within the last
+    ``event_topic_ttl`` seconds. Event names without handlers for longer than that are forgotten.
+    '''
+    now = time()
+    topics = []
+    for event_name, handlers in self.__handlers.items():
+      if event_name == self.TOPICS_EVENT:
+        continue
+      if handlers:
+        topics.append(event_name)
+        continue
+      empty_since = self.__empty_since.setdefault(event_name, now)
+      if now - empty_since < options.event_topic_ttl:
+        topics.append(event_name)
+        continue
+      with self.__handler_lock:
+        if not self.__handlers.get(event_name):
+          self.__handlers.pop(event_name, None)
+          self.__patterns.discard(event_name)
+          self.__empty_since.pop(event_name, None)
+          self.__subscribed_since.pop(event_name, None)
+          for backlog_name in self.__backlogs.keys():
+            if not self.__subscribed(backlog_name):
+              del self.__backlogs[backlog_name]
+              self.__evicted.pop(backlog_name, None)
+        else:
+          topics.append(event_name)
+    return topics
+
+  def aliases(self):
+    '''Returns the addresses other servers may use to reach this instance. If ``address`` binds to all interfaces ("*"),
+    the loopback address, host names and IP addresses of this host are substituted. Host names are resolved once and
+    cached.
+    '''
+    if self.advertised_addresses:
+      return list(self.advertised_addresses)
+    if not self.address:
+      return []
+    if '*' not in self.address:
+      return [self.address]
+    if self.__hosts is None:
+      hosts = set(['127.0.0.1', 'localhost'])
+      try:
+        hostname = sockets.gethostname()
+        hosts.add(hostname)
+        hosts.add(sockets.getfqdn())
+        hosts.update(sockets.gethostbyname_ex(hostname)[2])
+      except Exception as e:
+        logging.warning('Unable to resolve host addresses: %s' % e)
+      self.__hosts = hosts
+    return [self.address.replace('*', host) for host in self.__hosts]
+
+  def advertise(self, address=None, topics=None):
+    '''Send ``topics`` (by default the topics returned by ``subscribed_topics()``) to the server at ``address`` or all
+    registered servers if ``address`` is ``None``. This is called automatically when the topics change or a server is
+    registered.
+    '''
+    if topics is None:
+      topics = self.subscribed_topics()
+    self.__advertised = set(topics)
+    event_data = [self.TOPICS_EVENT, self.__encode(self.__event(self.TOPICS_EVENT, {'addresses': self.aliases(), 'topics': topics}))]
+    with self.__send_lock:
+      for server_address, socket in self.__remote_servers.items():
+        if address is None or server_address == address:
+          self.__send(socket, event_data)
+
+  def server_topics(self, address):
+    '''Returns the ``TopicSet`` most recently advertised by the server at ``address`` or ``None`` if that server has not
+    advertised its topics.
+    '''
+    return self.__server_topics.get(address)
+
+  def __accepts(self, address, event_name):
+    topics = self.__server_topics.get(address)
+    return topics is None or topics.matches(event_name)
+
+  def __receive_topics(self, args):
+    topics = TopicSet(args['topics'])
+    for address in args['addresses']:
+      self.__server_topics[address] = topics
+
+  def __has_handlers(self, event_name):
+    if self.__handlers.get(event_name):
+      return True
+    for pattern in list(self.__patterns):
+      if event_name.startswith(pattern[:-1]) and self.__handlers.get(pattern):
+        return True
+    return False
+
+  def __subscribed(self, event_name):
+    if event_name in self.__handlers:
+      return True
+    for pattern in list(self.__patterns):
+      if event_name.startswith(pattern[:-1]):
+        return True
+    return False
+
+  def __matching_handlers(self, event_name):
+    handlers = self.__handlers.get(event_name)
+    matches = handlers and [handlers] or []
+    for pattern in list(self.__patterns):
+      if event_name.startswith(pattern[:-1]):
+        handlers = self.__handlers.get(pattern)
+        if handlers:
+          matches.append(handlers)
+    return matches
+
+  def __counts(self, event_name):
+    # "sent" is only updated while holding __send_lock and "received" and __ignored only by the receive thread, so those
+    # counters are updated without __stats_lock. Ignored events are only counted in total so unknown event names do not
+    # add entries to __event_counts
+    counts = self.__event_counts.get(event_name)
+    if counts is None:
+      counts = self.__event_counts.setdefault(event_name, {'sent': 0, 'received': 0, 'dispatched': 0, 'skipped': 0})
+    return counts
+
+  def stats(self):
+    '''Returns a dictionary describing event delivery since the last call to ``reset_stats()``:
+
+    * ``events`` - a dictionary mapping each event name to the number of times an event was "sent" to a server or broker,
+      "received" for a registered handler, "dispatched" to a handler, or "skipped" because the handler's request had
+      already finished
+    * ``ignored`` - the total number of received events that were dropped because they had no handlers
+    * ``handlers`` - the number of handlers registered for each event name or pattern
+    * ``hwm_hits`` - the number of times a server's queue reached the ZMQ high water mark. Events for that server are
+      then held (up to ``event_overflow_size``) and retried in the background. Events published with the "pubsub"
+      transport are dropped by ZMQ instead and are not counted
+    * ``overflow`` - the number of events currently held for servers at the high water mark
+    * ``dropped`` - the number of held events that were dropped because a server's overflow was full
+    * ``swept`` - the number of registrations removed by ``sweep()``
+    * ``batched`` - the number of events currently waiting to be sent in batches
+    * ``receive_lag`` - ``toto.profiling.Histogram`` statistics for the time from ``send()`` until an event was received
+      by this server, including any batching delay and clock differences between servers
+    * ``loop_lag`` - ``toto.profiling.Histogram`` statistics for the time main loop handlers waited for the ``IOLoop``
+    * ``sequence`` - the sequence number of the most recently received event
+    '''
+    with self.__stats_lock:
+      stats = {'events': dict((event_name, dict(counts)) for event_name, counts in self.__event_counts.items()),
+          'ignored': self.__ignored, 'hwm_hits': self.__hwm_hits, 'dropped': self.__dropped, 'swept': self.__swept, 'receive_lag': self.__receive_lag.stats(), 'loop_lag': self.__loop_lag.stats()}
+    stats['handlers'] = dict((event_name, len(handlers)) for event_name, handlers in self.__handlers.items())
+    stats['batched'] = sum(len(batch) for batch in self.__batches.values())
+    stats['overflow'] = sum(len(overflow) for overflow in self.__overflow.values())
+    stats['sequence'] = self.__sequence
+    return stats
+
+  def reset_stats(self):
+    '''Clear the counters and histograms reported by ``stats()``.
+    '''
+    with self.__stats_lock:
+      self.__event_counts.clear()
+      self.__ignored = 0
+      self.__hwm_hits = 0
+      self.__dropped = 0
+      self.__swept = 0
+      self.__receive_lag = Histogram()
+      self.__loop_lag = Histogram()
+
+  def __dispatch(self, event_name, event_args):
+    main_loop_handlers = []
+    background_handlers = []
+    skipped = 0
+    with self.__handler_lock:
+      self.__sequence += 1
+      events = [(self.__sequence, event_args)]
+      if self.backlog_size:
+        self.__record(event_name, self.__sequence, event_args)
+      for handlers in self.__matching_handlers(event_name):
+        for handler in list(handlers):
+          if not handler[3]:
+            handlers.discard(handler)
+          if self.__finished(handler):
+            skipped += 1
+            continue
+          if handler[1]:
+            main_loop_handlers.append(handler)
+          else:
+            background_handlers.append(handler)
+      if main_loop_handlers:
+        scheduled = time()
+        IOLoop.instance().add_callback(lambda: self.__run_handlers(event_name, main_loop_handlers, event_args, events, 0, scheduled))
+    if skipped:
+      with self.__stats_lock:
+        self.__counts(event_name)['skipped'] += skipped
+    if background_handlers:
+      self.__run_handlers(event_name, background_handlers, event_args, events, 0)
+
+  def __run_handlers(self, event_name, handlers, event_args, events, start, scheduled=None):
+    # Main loop handlers are split into slices so other callbacks are not delayed for long
+    now = time()
+    if scheduled:
+      with self.__stats_lock:
+        self.__loop_lag.add(now - scheduled)
+    deadline = now + options.event_dispatch_slice / 1000.0
+    dispatched = 0
+    skipped = 0
+    try:
+      for i in xrange(start, len(handlers)):
+        if i > start and handlers[i][1] and time() >= deadline:
+          IOLoop.instance().add_callback(lambda: self.__run_handlers(event_name, handlers, event_args, events, i))
+          return
+        handler = handlers[i]
+        try:
+          if self.__finished(handler):
+            skipped += 1
+            continue
+          dispatched += 1
+          handler[0](events if handler[4] else event_args)
+        except Exception as e:
+          logging.error(format_exc())
+    finally:
+      with self.__stats_lock:
+        counts = self.__counts(event_name)
+        counts['dispatched'] += dispatched
+        counts['skipped'] += skipped
+
+  def __wake(self):
+    with self.__send_lock:
+      if not self.__control:
+        self.__control = self.__zmq_context.socket(zmq.PUSH)
+        self.__control.connect(self.__control_address)
+      self.__control.send('topics')
+
+  def __wanted(self, event_name):
+    if event_name == self.TOPICS_EVENT:
+      return True
+    if self.backlog_size:
+      return self.__subscribed(event_name)
+    return self.__has_handlers(event_name)
+
+  def __receive(self, frames):
+    try:
+      if len(frames) == 1:
+        events = [self.__decode(frames[0])]
+      elif frames[0] == self.BATCH_TOPIC:
+        event_names = frames[1].split('\0')
+        for event_name in event_names:
+          if self.__wanted(event_name):
+            break
+        else:
+          self.__ignored += len(event_names)
+          return
+        events = self.__decode(frames[2])
+      else:
+        if not self.__wanted(frames[0]):
+          self.__ignored += 1
+          return
+        events = self.__decode(frames[1])
+        if not isinstance(events, list):
+          events = [events]
+      now = time()
+      for event in events:
+        if event['name'] == self.TOPICS_EVENT:
+          self.__receive_topics(event['args'])
+          continue
+        if 'time' in event:
+          self.__receive_lag.add(max(now - event['time'], 0.0))
+        if self.__wanted(event['name']):
+          self.__counts(event['name'])['received'] += 1
+          self.__dispatch(event['name'], event['args'])
+        else:
+          self.__ignored += 1
+    except Exception as e:
+      logging.error(format_exc())
+
   def start_listening(self):
     '''Starts listening for incoming events on ``EventManager.address``.
     '''
     if self.__thread:
       return
-    def receive():
-      context = zmq.Context()
-      socket = context.socket(zmq.PULL)
+    poller = zmq.Poller()
+    control = self.__zmq_context.socket(zmq.PULL)
+    control.bind(self.__control_address)
+    poller.register(control, zmq.POLLIN)
+    event_sockets = []
+    if self.address:
+      socket = self.__zmq_context.socket(zmq.PULL)
       socket.bind(self.address)
+      event_sockets.append(socket)
+    subscriber = None
+    if self.transport == 'pubsub':
+      subscriber = self.__zmq_context.socket(zmq.SUB)
+      subscriber.connect(self.subscribe_address)
+      event_sockets.append(subscriber)
+    for socket in event_sockets:
+      poller.register(socket, zmq.POLLIN)
+    subscriptions = set()
+
+    def refresh_topics():
+      topics = self.subscribed_topics()
+      if self.__advertised is None or set(topics) != self.__advertised:
+        self.advertise(topics=topics)
+      if subscriber:
+        prefixes = set()
+        for topic in topics:
+          prefix = topic[:-1] if topic.endswith('*') else topic
+          prefixes.add(isinstance(prefix, unicode) and prefix.encode('utf-8') or prefix)
+        for prefix in prefixes - subscriptions:
+          subscriber.setsockopt(zmq.SUBSCRIBE, prefix)
+        for prefix in subscriptions - prefixes:
+          subscriber.setsockopt(zmq.UNSUBSCRIBE, prefix)
+        subscriptions.clear()
+        subscriptions.update(prefixes)
+
+    def receive():
+      next_maintenance = time() + self.MAINTENANCE_INTERVAL
+      next_sweep = time() + options.event_sweep_interval
       while True:
-        event = pickle.loads(zlib.decompress(socket.recv()))
-        event_name = event['name']
-        event_args = event['args']
-        if event_name in self.__handlers:
-          handlers = self.__handlers[event_name]
-          for handler in list(handlers):
-            if not handler[3]:
-              handlers.remove(handler)
-            try:
-              if handler[2] and handler[2]._finished:
-                continue
-              if handler[1]:
-                (lambda h: IOLoop.instance().add_callback(lambda: h[0](event_args)))(handler)
-              else:
-                handler[0](event_args)
-            except Exception as e:
-              logging.error(format_exc())
+        try:
+          ready = dict(poller.poll(self.MAINTENANCE_INTERVAL * 1000))
+          if control in ready:
+            while control.poll(0):
+              control.recv()
+            refresh_topics()
+          for socket in event_sockets:
+            if socket in ready:
+              while socket.poll(0):
+                self.__receive(socket.recv_multipart())
+          if time() >= next_maintenance:
+            next_maintenance = time() + self.MAINTENANCE_INTERVAL
+            if time() >= next_sweep:
+              next_sweep = time() + options.event_sweep_interval
+              self.sweep()
+            refresh_topics()
+        except Exception as e:
+          logging.error(format_exc())
     self.__thread = Thread(target=receive)
     self.__thread.daemon = True
     self.__thread.start()
-  
+    self.__wake()
+
+  @staticmethod
+  def start_broker(publish_address, subscribe_address):
+    '''Start a thread that forwards events published to ``publish_address`` to the servers subscribed at
+    ``subscribe_address`` when using the "pubsub" transport. Subscriptions are forwarded to publishers so events are
+    only sent where they are handled. Toto servers will start a broker in the first server process if the
+    ``event_broker`` option is set. Returns the ``zmq.devices.ThreadDevice`` running the broker.
+    '''
+    from zmq.devices import ThreadDevice
+    device = ThreadDevice(zmq.FORWARDER, zmq.XSUB, zmq.XPUB)
+    device.bind_in(publish_address)
+    device.bind_out(subscribe_address)
+    device.daemon = True
+    device.start()
+    return device
+
+  def __encode(self, value):
+    data = self.codec.dumps(value)
+    if len(data) < self.compression_threshold:
+      return '\0' + data
+    return zlib.compress(data)
+
+  def __decode(self, data):
+    if data[:1] == '\0':
+      return self.codec.loads(data[1:])
+    return self.codec.loads(zlib.decompress(data))
+
+  def __event(self, event_name, event_args):
+    if isinstance(event_name, unicode):
+      event_name = event_name.encode('utf-8')
+    return {'name': event_name, 'args': event_args, 'time': time()}
+
+  def __send(self, socket, frames):
+    # Must be called with __send_lock held. Frames for a server at the high water mark are held in __overflow and
+    # retried by the batch thread, so a slow server does not block sends to other servers
+    overflow = self.__overflow.get(socket)
+    if overflow is None:
+      try:
+        socket.send_multipart(frames, zmq.NOBLOCK)
+        return
+      except zmq.ZMQError as e:
+        if e.errno != zmq.EAGAIN:
+          raise
+      self.__hwm_hits += 1
+      overflow = self.__overflow[socket] = deque(maxlen=self.overflow_size)
+      self.__start_batch_thread()
+      self.__batch_condition.notify()
+    if len(overflow) == overflow.maxlen:
+      self.__dropped += 1
+    overflow.append(frames)
+
+  def __send_overflow(self, socket):
+    overflow = self.__overflow[socket]
+    try:
+      while overflow:
+        socket.send_multipart(overflow[0], zmq.NOBLOCK)
+        overflow.popleft()
+    except zmq.ZMQError as e:
+      if e.errno != zmq.EAGAIN:
+        raise
+      return
+    del self.__overflow[socket]
+
+  def __deliver(self, sockets, event):
+    # Must be called with __send_lock held
+    if sockets:
+      self.__counts(event['name'])['sent'] += len(sockets)
+    frames = None
+    if not self.batch_size:
+      if sockets:
+        frames = [event['name'], self.__encode(event)]
+      for socket in sockets:
+        self.__send(socket, frames)
+      return
+    now = time()
+    delay = self.batch_delay / 1000.0
+    for socket in sockets:
+      batch = self.__batches.get(socket)
+      if batch is None:
+        if now - self.__last_sent.get(socket, 0) >= delay:
+          frames = frames or [event['name'], self.__encode(event)]
+          self.__send(socket, frames)
+          self.__last_sent[socket] = now
+          continue
+        batch = self.__batches[socket] = []
+        self.__batch_deadlines[socket] = now + delay
+        self.__start_batch_thread()
+        self.__batch_condition.notify()
+      batch.append(event)
+      if len(batch) >= self.batch_size:
+        self.__flush_batch(socket)
+
+  def __flush_batch(self, socket):
+    batch = self.__batches.pop(socket)
+    del self.__batch_deadlines[socket]
+    self.__last_sent[socket] = time()
+    if len(batch) == 1:
+      self.__send(socket, [batch[0]['name'], self.__encode(batch[0])])
+    elif socket is self.__publisher:
+      # Subscribers filter on the first frame, so published batches are split by event name
+      topics = {}
+      for event in batch:
+        topics.setdefault(event['name'], []).append(event)
+      for event_name, events in topics.iteritems():
+        self.__send(socket, [event_name, self.__encode(events)])
+    else:
+      self.__send(socket, [self.BATCH_TOPIC, '\0'.join(set(event['name'] for event in batch)), self.__encode(batch)])
+
+  def __discard_batch(self, socket):
+    self.__overflow.pop(socket, None)
+    self.__batches.pop(socket, None)
+    self.__batch_deadlines.pop(socket, None)
+    self.__last_sent.pop(socket, None)
+
+  def __start_batch_thread(self):
+    if self.__batch_thread:
+      return
+    def flush_batches():
+      with self.__batch_condition:
+        while True:
+          if not self.__batch_deadlines and not self.__overflow:
+            self.__batch_condition.wait()
+            continue
+          now = time()
+          for socket in self.__overflow.keys():
+            try:
+              self.__send_overflow(socket)
+            except Exception as e:
+              self.__overflow.pop(socket, None)
+              logging.error(format_exc())
+          for socket, deadline in self.__batch_deadlines.items():
+            if deadline <= now:
+              try:
+                self.__flush_batch(socket)
+              except Exception as e:
+                logging.error(format_exc())
+          deadlines = self.__batch_deadlines.values()
+          if self.__overflow:
+            deadlines.append(now + self.OVERFLOW_RETRY)
+          if deadlines:
+            self.__batch_condition.wait(max(min(deadlines) - now, 0.0001))
+    self.__batch_thread = Thread(target=flush_batches)
+    self.__batch_thread.daemon = True
+    self.__batch_thread.start()
+
+  def flush(self):
+    '''Immediately send all batched events.
+    '''
+    with self.__send_lock:
+      for socket in self.__batches.keys():
+        self.__flush_batch(socket)
+
   def send_to_server(self, address, event_name, event_args):
     '''Send a message with ``event_name`` and ``event_args`` only
     to the server listening at ``address``. ``address`` must have
@@ -115,27 +859,48 @@ class EventManager():
     efficient than ``send`` if you only intent to send the event
     to a single server and know the address in advance.
     '''
-    event = {'name': event_name, 'args': event_args}
-    event_data = zlib.compress(pickle.dumps(event))
-    self.__remote_servers[address].send(event_data)
-  
-  def send(self, event_name, event_args, broadcast=True):
+    event = self.__event(event_name, event_args)
+    with self.__send_lock:
+      self.__deliver([self.__remote_servers[address]], event)
+
+  def send(self, event_name, event_args, broadcast=True, key=None):
     '''Send a message with ``event_name`` and ``event_args`` to
-    all servers previously registered with ``register_server()``.
-    If ``broadcast`` is false, the event will be sent to only
-    a single server. Non-broadcast events are round-robin load
-    balanced between registered servers.
+    all servers previously registered with ``register_server()``
+    that have handlers for ``event_name``. If ``broadcast`` is false,
+    the event will be sent to only a single server. Non-broadcast events
+    are round-robin load balanced between registered servers.
+
+    If ``key`` is set, the event is sent only to the server chosen for
+    ``key`` by consistent hashing (see ``server_for_key()``) and
+    ``broadcast`` is ignored. The event is dropped if that server has
+    not advertised a handler for it.
+
+    With the "pubsub" transport, broadcast events are published to the
+    event broker instead.
     '''
-    if not self.__remote_servers:
+    event = self.__event(event_name, event_args)
+    if key is not None:
+      with self.__send_lock:
+        server = self.__server_for_key(key)
+        if server and self.__accepts(server[0], event['name']):
+          self.__deliver([server[1]], event)
+      return
+    if broadcast and self.transport == 'pubsub':
+      with self.__send_lock:
+        self.__deliver([self.__publisher], event)
       return
-    event = {'name': event_name, 'args': event_args}
-    event_data = zlib.compress(pickle.dumps(event))
-    if not broadcast:
-      self.__queued_servers[0].send(event_data)
-      self.__queued_servers.rotate(-1)
+    if not self.__remote_servers:
       return
-    for socket in self.__queued_servers:
-      socket.send(event_data)
+    with self.__send_lock:
+      if not broadcast:
+        for i in xrange(len(self.__queued_servers)):
+          address, socket = self.__queued_servers[0]
+          self.__queued_servers.rotate(-1)
+          if self.__accepts(address, event['name']):
+            self.__deliver([socket], event)
+            return
+        return
+      self.__deliver([socket for address, socket in self.__queued_servers if self.__accepts(address, event['name'])], event)
 
   @classmethod
   def instance(cls):
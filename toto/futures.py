@@ -0,0 +1,207 @@
+'''``toto.futures`` provides a minimal, thread safe ``Future`` used by Toto's asynchronous APIs. Toto methods
+may return a ``Future`` from ``invoke`` and the request will be finished with its result once it resolves.
+
+A ``Future`` created with an ``io_loop`` will run its done callbacks on that ``IOLoop`` no matter which
+thread resolves it, so callbacks can safely write to request handlers.
+'''
+
+from threading import Condition, Lock
+from traceback import format_exc
+import sys
+import logging
+
+class CancelledError(Exception):
+  '''Raised when retrieving the result of a cancelled ``Future``.
+  '''
+  pass
+
+class TimeoutError(Exception):
+  '''Raised when a ``Future`` does not resolve in time.
+  '''
+  pass
+
+class Future(object):
+  '''A placeholder for the result of an operation that has not completed yet. The interface
+  mirrors ``concurrent.futures.Future``. If ``io_loop`` is set, done callbacks will be scheduled on
+  ``io_loop`` with ``add_callback``.
+  '''
+
+  def __init__(self, io_loop=None):
+    self.io_loop = io_loop
+    self.__condition = Condition()
+    self.__done = False
+    self.__cancelled = False
+    self.__result = None
+    self.__exc_info = None
+    self.__callbacks = []
+
+  def done(self):
+    '''Returns ``True`` if the future has a result, an exception or has been cancelled.
+    '''
+    return self.__done
+
+  def cancelled(self):
+    return self.__cancelled
+
+  def cancel(self):
+    '''Cancel the future if it has not resolved yet. Returns ``True`` if the future was cancelled.
+    '''
+    with self.__condition:
+      if self.__done:
+        return False
+      self.__cancelled = True
+      self.__exc_info = (CancelledError, CancelledError(), None)
+      self.__done = True
+      self.__condition.notify_all()
+    self.__run_callbacks()
+    return True
+
+  def result(self, timeout=None):
+    '''Returns the result of the future, raising its exception if it failed. If the future has not
+    resolved, this call will block for up to ``timeout`` seconds (forever if ``None``). Never block
+    on an ``IOLoop`` that is needed to resolve the future.
+    '''
+    self.__wait(timeout)
+    if self.__exc_info:
+      raise self.__exc_info[0], self.__exc_info[1], self.__exc_info[2]
+    return self.__result
+
+  def exception(self, timeout=None):
+    '''Returns the exception raised by the operation, or ``None`` if it succeeded.
+    '''
+    self.__wait(timeout)
+    return self.__exc_info and self.__exc_info[1] or None
+
+  def exc_info(self):
+    '''Returns the ``(type, value, traceback)`` tuple of a failed future or ``None``.
+    '''
+    return self.__exc_info
+
+  def __wait(self, timeout):
+    with self.__condition:
+      if not self.__done:
+        self.__condition.wait(timeout)
+      if not self.__done:
+        raise TimeoutError()
+
+  def add_done_callback(self, fn):
+    '''Call ``fn(future)`` when this future resolves. If the future has already resolved, ``fn`` will be
+    called (or scheduled on ``io_loop``) immediately.
+    '''
+    with self.__condition:
+      if not self.__done:
+        self.__callbacks.append(fn)
+        return
+    self.__run_callback(fn)
+
+  def set_result(self, result):
+    with self.__condition:
+      if self.__done:
+        return
+      self.__result = result
+      self.__done = True
+      self.__condition.notify_all()
+    self.__run_callbacks()
+
+  def set_exception(self, exception, traceback=None):
+    with self.__condition:
+      if self.__done:
+        return
+      self.__exc_info = (exception.__class__, exception, traceback)
+      self.__done = True
+      self.__condition.notify_all()
+    self.__run_callbacks()
+
+  def set_exc_info(self, exc_info):
+    self.set_exception(exc_info[1], exc_info[2])
+
+  def copy_result(self, future):
+    '''Resolve this future with the result or exception of ``future``.
+    '''
+    if future.exc_info():
+      self.set_exc_info(future.exc_info())
+    else:
+      self.set_result(future.result())
+
+  def __run_callbacks(self):
+    callbacks, self.__callbacks = self.__callbacks, []
+    for fn in callbacks:
+      self.__run_callback(fn)
+
+  def __run_callback(self, fn):
+    if self.io_loop:
+      self.io_loop.add_callback(lambda: fn(self))
+      return
+    try:
+      fn(self)
+    except Exception as e:
+      logging.error(format_exc())
+
+def then(value, callback=None, errback=None):
+  '''Chain ``callback`` to ``value``. If ``value`` is not a ``Future``, ``callback(value)`` is returned
+  directly so synchronous code paths are unaffected. Otherwise a new ``Future`` is returned that will
+  resolve with ``callback(value.result())``. If ``callback`` returns a ``Future``, the new future will
+  resolve with its result.
+
+  If ``errback`` is set, it will be called with the exception of a failed future from inside an ``except``
+  block (so a bare ``raise`` will re-raise it) and its return value will be used as the result.
+  '''
+  if not isinstance(value, Future):
+    return callback(value) if callback else value
+  future = Future(value.io_loop)
+  def resolve(f):
+    try:
+      try:
+        result = f.result()
+      except Exception as e:
+        if not errback:
+          raise
+        result = errback(e)
+      else:
+        if callback:
+          result = callback(result)
+    except Exception as e:
+      future.set_exc_info(sys.exc_info())
+      return
+    if isinstance(result, Future):
+      result.add_done_callback(future.copy_result)
+    else:
+      future.set_result(result)
+  value.add_done_callback(resolve)
+  return future
+
+def gather(values, io_loop=None):
+  '''Returns a ``Future`` that resolves with a list of the results of ``values`` once every ``Future`` in ``values``
+  has resolved. Values that are not futures are included in the list unchanged. If any future fails, the returned
+  future fails with the first exception. Cancelling the returned future cancels the futures in ``values``. Done callbacks
+  run on ``io_loop`` if set.
+  '''
+  values = list(values)
+  future = Future(io_loop)
+  results = list(values)
+  pending = [i for i, value in enumerate(values) if isinstance(value, Future)]
+  remaining = [len(pending)]
+  lock = Lock()
+  if not pending:
+    future.set_result(results)
+    return future
+  def resolve(i):
+    def done(f):
+      if f.exc_info():
+        future.set_exc_info(f.exc_info())
+        return
+      results[i] = f.result()
+      with lock:
+        remaining[0] -= 1
+        if remaining[0]:
+          return
+      future.set_result(results)
+    return done
+  def cancel(f):
+    if f.cancelled():
+      for i in pending:
+        values[i].cancel()
+  for i in pending:
+    values[i].add_done_callback(resolve(i))
+  future.add_done_callback(cancel)
+  return future
@@ -1,18 +1,24 @@
 from tornado.web import *
-import json
-import hashlib
-import hmac
 from invocation import *
 from exceptions import *
+from dispatch import DispatchTable
+from futures import Future, then
+from serialization import get_codec, codec_for_content_type, negotiate
+from signing import HMACSigner
+from profiling import Profiler, NULL_TIMER
+from tornado.ioloop import IOLoop
 from tornado.options import define, options
-import base64
 from tornado.httputil import parse_multipart_form_data
+from time import time
+from types import GeneratorType
 import logging
 
 define("allow_origin", default="*", help="This is the value for the Access-Control-Allow-Origin header (default *)")
 define("method_select", default="both", metavar="both|url|parameter", help="Selects whether methods can be specified via URL, parameter in the message body or both (default both)")
 define("bson_enabled", default=False, help="Allows requests to use BSON with content-type application/bson")
 define("msgpack_enabled", default=False, help="Allows requests to use MessagePack with content-type application/msgpack")
+define("http_codecs", default=None, type=str, multiple=True, help="A comma separated list of the codecs (see toto.serialization) that requests may use, selected by the content-type and accept headers. JSON is always enabled")
+define("batch_timeout", default=0.0, help="The number of seconds to wait for all requests in a batch to complete before responding with timeout errors for the remaining requests, or zero to wait indefinitely")
 
 class TotoHandler(RequestHandler):
   '''The handler is responsible for processing all requests to the server. An instance
@@ -48,14 +54,16 @@ class TotoHandler(RequestHandler):
 
   SUPPORTED_METHODS = {"POST", "OPTIONS", "GET", "HEAD"}
   ACCESS_CONTROL_ALLOW_ORIGIN = options.allow_origin
+  STREAM_BUFFER_SIZE = 64 * 1024
+  http_codecs = {'json'}
+  profiler = None
 
   def initialize(self, db_connection):
     self.db_connection = db_connection
     self.db = self.db_connection.db
-    self.bson = options.bson_enabled and __import__('bson').BSON
-    self.msgpack = options.msgpack_enabled and __import__('msgpack')
     self.response_type = 'application/json'
     self.body = None
+    self.timer = self.profiler and self.profiler.timer() or NULL_TIMER
     self.registered_event_handlers = []
     self.__active_methods = []
     self.headers_only = False
@@ -71,7 +79,7 @@ class TotoHandler(RequestHandler):
     if options.method_select == 'url':
       def get_method_path(self, path, body):
         if path:
-          return path.split('/')
+          return path
         else:
           raise TotoException(ERROR_MISSING_METHOD, "Missing method.")
       cls.__get_method_path = get_method_path
@@ -79,7 +87,7 @@ class TotoHandler(RequestHandler):
       def get_method_path(self, path, body):
         if body and 'method' in body:
           logging.info(body['method'])
-          return body['method'].split('.')
+          return body['method']
         else:
           raise TotoException(ERROR_MISSING_METHOD, "Missing method.")
       cls.__get_method_path = get_method_path
@@ -88,23 +96,23 @@ class TotoHandler(RequestHandler):
       import math
       set_cookie = options.secure_cookies and cls.set_secure_cookie or cls.set_cookie
       get_cookie = options.secure_cookies and cls.get_secure_cookie or cls.get_cookie
-      def create_session(self, user_id=None, password=None):
-        self.session = self.db_connection.create_session(user_id, password)
-        set_cookie(self, name='toto-session-id', value=self.session.session_id, expires_days=math.ceil(self.session.expires / (24.0 * 60.0 * 60.0)), domain=options.cookie_domain)
-        return self.session
-      cls.create_session = create_session
-      
-      def retrieve_session(self, session_id=None):
-        if not self.session or (session_id and self.session.session_id != session_id):
-          headers = self.request.headers
-          if not session_id:
-            session_id = 'x-toto-session-id' in headers and headers['x-toto-session-id'] or get_cookie(self, 'toto-session-id')
-          if session_id:
-            self.session = self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, 'x-toto-hmac' in headers and self.request.body or None)
+      def set_session_cookie(self, session):
+        self.session = session
         if self.session:
           set_cookie(self, name='toto-session-id', value=self.session.session_id, expires_days=math.ceil(self.session.expires / (24.0 * 60.0 * 60.0)), domain=options.cookie_domain)
         return self.session
-      cls.retrieve_session = retrieve_session
+      cls._store_session = set_session_cookie
+
+      def session_id(self):
+        headers = self.request.headers
+        return 'x-toto-session-id' in headers and headers['x-toto-session-id'] or get_cookie(self, 'toto-session-id')
+      cls._session_id = session_id
+
+      def fetch_session(self, session_id):
+        headers = self.request.headers
+        start = time()
+        return self.timer.measure('session', start, self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, 'x-toto-hmac' in headers and self.request.body or None))
+      cls._fetch_session = fetch_session
     if options.debug:
       import traceback
       def error_info(self, e):
@@ -115,7 +123,15 @@ class TotoHandler(RequestHandler):
           logging.error('%s\n%s\nHeaders: %s\n' % (e, traceback.format_exc(), repr(self.request.headers)))
           return TotoException(ERROR_SERVER, str(e)).__dict__
       cls.error_info = error_info
-    cls.__method_root = __import__(options.method_module)
+    cls.dispatch_table = DispatchTable(__import__(options.method_module))
+    cls.profiler = Profiler.enabled() and Profiler.instance('http') or None
+    cls.http_codecs = set(['json'] + (options.http_codecs or []))
+    if options.bson_enabled:
+      cls.http_codecs.add('bson')
+    if options.msgpack_enabled:
+      cls.http_codecs.add('msgpack')
+    for name in cls.http_codecs:
+      get_codec(name)
       
   def __get_method_path(self, path, body):
     """The default method_select "both" (or any unsupported value) will
@@ -123,19 +139,13 @@ class TotoHandler(RequestHandler):
     to a more efficient method according to ``tornado.options``.
     """
     if path:
-      return path.split('/')
+      return path
     elif body and 'method' in body:
       logging.info(body['method'])
-      return body['method'].split('.')
+      return body['method']
     else:
       raise TotoException(ERROR_MISSING_METHOD, "Missing method.")
 
-  def __get_method(self, path):
-    method = self.__method_root
-    for i in path:
-      method = getattr(method, i)
-    return method
-
   def error_info(self, e):
     if isinstance(e, TotoException):
       logging.error("TotoException: %s Value: %s" % (e.code, e.value))
@@ -145,17 +155,21 @@ class TotoHandler(RequestHandler):
       logging.error("TotoException: %s Value: %s" % (e.code, e.value))
       return e.__dict__
 
-  def invoke_method(self, path, request_body, parameters, finish_by_default=True):
+  def invoke_method(self, path, request_body, parameters, finish_by_default=True, handler=None):
     result = None
     error = None
-    method = None
+    asynchronous = False
     try:
-      method = self.__get_method(self.__get_method_path(path, request_body))
+      method_path = self.__get_method_path(path, request_body)
+      (method, invoke, asynchronous) = self.dispatch_table.get(method_path)
       self.__active_methods.append(method)
-      result = method.invoke(self, parameters)
+      if not handler:
+        self.timer.method = method_path.replace('/', '.')
+      start = time()
+      result = self.timer.measure('invoke', start, invoke(handler or self, parameters))
     except Exception as e:
       error = self.error_info(e)
-    return result, error, (finish_by_default and not hasattr(method, 'asynchronous'))
+    return result, error, (finish_by_default and not asynchronous)
 
   def options(self, path=None):
     allowed_headers = set(['x-toto-hmac','x-toto-session-id','origin','content-type'])
@@ -182,24 +196,31 @@ class TotoHandler(RequestHandler):
         parameters[k] = v[0]
       else:
         parameters[k] = v
+    self.negotiate_response_type()
     self.process_request(path, self.body, parameters)
 
+  def negotiate_response_type(self):
+    '''Set ``response_type`` to the first enabled codec listed in the request's "accept" header. If no codec is
+    acceptable, ``response_type`` is unchanged (matching the request's content type).
+    '''
+    codec = negotiate(self.request.headers.get('accept'), self.http_codecs)
+    if codec:
+      self.response_type = codec.content_type
+
   @tornado.web.asynchronous
   def post(self, path=None):
+    start = time()
     content_type = 'content-type' in self.request.headers and self.request.headers['content-type'] or 'application/json'
-    if not content_type.startswith('application/json'):
-      if content_type.startswith('application/x-www-form-urlencoded'):
-        self.body = {'parameters': self.request.arguments}
-      elif content_type.startswith('multipart/form-data'):
-        self.body = {'parameters': {'arguments': self.request.arguments, 'files': self.request.files}}
-      elif self.bson and content_type.startswith('application/bson'):
-        self.response_type = 'application/bson'
-        self.body = self.bson(self.request.body).decode()
-      elif self.msgpack and content_type.startswith('application/msgpack'):
-        self.response_type = 'application/msgpack'
-        self.body = self.msgpack.loads(self.request.body)
-    else:
-      self.body = json.loads(self.request.body)
+    codec = codec_for_content_type(content_type, self.http_codecs)
+    if codec:
+      self.response_type = codec.content_type
+      self.body = codec.loads(self.request.body)
+    elif content_type.startswith('application/x-www-form-urlencoded'):
+      self.body = {'parameters': self.request.arguments}
+    elif content_type.startswith('multipart/form-data'):
+      self.body = {'parameters': {'arguments': self.request.arguments, 'files': self.request.files}}
+    self.negotiate_response_type()
+    self.timer.add('parse', start)
     if self.body and 'batch' in self.body:
       self.batch_process_request(self.body['batch'])
     else:
@@ -207,33 +228,234 @@ class TotoHandler(RequestHandler):
   
   def batch_process_request(self, requests):
     self.session = None
+    self.timer.method = 'batch'
     self.add_header('access-control-allow-origin', self.ACCESS_CONTROL_ALLOW_ORIGIN)
     self.add_header('access-control-expose-headers', 'x-toto-hmac')
     request_keys = sorted(requests.keys())
     batch_results = {}
-    for k, v in ((i, requests[i]) for i in request_keys):
-      (result, error, finish_by_default) = self.invoke_method(None, v, v['parameters'], False)
-      batch_results[k] = error is not None and {'error': isinstance(error, dict) and error or self.error_info(error)} or {'result': result}
-    self.respond(batch_results=batch_results)
+    pending = set(request_keys)
+    io_loop = IOLoop.instance()
+    timeout = []
+
+    def finish_batch():
+      if self._finished:
+        return
+      if timeout:
+        io_loop.remove_timeout(timeout[0])
+      for k in pending:
+        batch_results[k] = {'error': self.error_info(TotoException(ERROR_TIMEOUT, "Batch request timed out"))}
+      pending.clear()
+      self.respond(batch_results=batch_results)
+
+    def complete(key, result, error):
+      if key not in pending:
+        return
+      pending.discard(key)
+      if isinstance(result, GeneratorType):
+        result = list(result)
+      batch_results[key] = error is not None and {'error': isinstance(error, dict) and error or self.error_info(error)} or {'result': result}
+      if not pending:
+        finish_batch()
+
+    def future_done(key, future):
+      try:
+        complete(key, future.result(), None)
+      except Exception as e:
+        complete(key, None, e)
+
+    def dispatch():
+      for k, v in ((i, requests[i]) for i in request_keys):
+        item_handler = BatchItemHandler(self, lambda result, error, k=k: complete(k, result, error))
+        (result, error, finish_by_default) = self.invoke_method(None, v, v['parameters'], True, item_handler)
+        if error is not None:
+          complete(k, None, error)
+        elif isinstance(result, Future):
+          result.add_done_callback(lambda f, k=k: io_loop.add_callback(lambda: future_done(k, f)))
+        elif result is not None or finish_by_default:
+          complete(k, result, None)
+      if not pending:
+        finish_batch()
+
+    if options.batch_timeout:
+      timeout.append(io_loop.add_timeout(time() + options.batch_timeout, finish_batch))
+    # The header session is resolved once and shared by every item. If it fails, items that need it will report the
+    # error when they retrieve it themselves
+    try:
+      session = self.retrieve_session()
+    except Exception as e:
+      session = None
+    if isinstance(session, Future):
+      session.add_done_callback(lambda f: io_loop.add_callback(dispatch))
+    else:
+      dispatch()
 
   def process_request(self, path, request_body, parameters, finish_by_default=True):
     self.session = None
     self.add_header('access-control-allow-origin', self.ACCESS_CONTROL_ALLOW_ORIGIN)
     self.add_header('access-control-expose-headers', 'x-toto-hmac')
     (result, error, finish_by_default) = self.invoke_method(path, request_body, parameters, finish_by_default)
-    if result is not None or error:
+    if isinstance(result, Future):
+      self.respond_future(result, finish_by_default)
+    elif isinstance(result, GeneratorType):
+      self.respond_stream(result)
+    elif result is not None or error:
       self.respond(result, error)
     elif finish_by_default and not self._finished:
       self.finish()
 
+  def respond_future(self, future, finish=True):
+    '''Respond with the result of ``future`` (a ``toto.futures.Future``) once it resolves. This is called automatically
+    when a method's invoke function returns a future. If the future fails, a normal Toto error response will be sent.
+    If the result is ``None`` the request will be finished unless ``finish`` is ``False``.
+    '''
+    io_loop = IOLoop.instance()
+    def future_done(future):
+      if self._finished:
+        return
+      try:
+        result = future.result()
+      except Exception as e:
+        self.respond(error=e)
+        return
+      if isinstance(result, GeneratorType):
+        self.respond_stream(result)
+      elif result is not None:
+        self.respond(result)
+      elif finish:
+        self.finish()
+    future.add_done_callback(lambda f: io_loop.add_callback(lambda: future_done(f)))
+
+  def respond_stream(self, items):
+    '''Respond with each item from the iterable ``items`` as it becomes available. This is called automatically when a
+    method's invoke function returns a generator, so large results can be produced and sent incrementally instead of being
+    held in memory::
+
+      def invoke(handler, parameters):
+        for row in handler.db.query('select * from item'):
+          yield row
+
+    Items may be ``toto.futures.Future`` instances; the stream will wait for each future to resolve before continuing.
+
+    For JSON responses to HTTP/1.1 clients, the response is sent with chunked transfer encoding as
+    ``{"session": ..., "result": [item, ...]}``, flushing every ``STREAM_BUFFER_SIZE`` bytes. The ``x-toto-hmac``
+    signature is computed incrementally and sent as a trailer. If an error occurs after the stream has started, the
+    "result" list will end and the error will be included in the "error" property as usual. Other response types and HEAD
+    requests collect the items and respond normally.
+    '''
+    io_loop = IOLoop.instance()
+    dumps = get_codec('json').dumps
+    iterator = iter(items)
+    streaming = self.response_type == 'application/json' and self.request.supports_http_1_1() and not self.headers_only
+    collected = []
+    buffer = []
+    state = {'first': True, 'size': 0}
+    signature = streaming and self.session and HMACSigner.instance().new(str(self.session.user_id).lower())
+
+    def send(data):
+      buffer.append(data)
+      state['size'] += len(data)
+
+    def flush_stream(callback=None):
+      data = ''.join(buffer)
+      del buffer[:]
+      state['size'] = 0
+      if data:
+        if signature:
+          start = time()
+          signature.update(data)
+          self.timer.add('hmac', start)
+        start = time()
+        self.write('%x\r\n%s\r\n' % (len(data), data))
+        self.timer.add('write', start)
+      self.flush(callback=callback)
+
+    def add(item):
+      if not streaming:
+        collected.append(item)
+        return
+      start = time()
+      if state['first']:
+        state['first'] = False
+        send(dumps(item))
+      else:
+        send(',' + dumps(item))
+      self.timer.add('serialize', start)
+
+    def finish_stream(error=None):
+      if not streaming:
+        if error:
+          self.respond(error=error)
+        else:
+          self.respond(collected)
+        return
+      if error:
+        send('], "error": %s}' % dumps(isinstance(error, dict) and error or self.error_info(error)))
+      else:
+        send(']}')
+      flush_stream()
+      self.write('0\r\n%s\r\n' % (signature and 'x-toto-hmac: %s\r\n' % signature.b64digest() or ''))
+      self.finish()
+
+    def closed():
+      if self._finished or self.request.connection.stream.closed():
+        if hasattr(iterator, 'close'):
+          iterator.close()
+        return True
+      return False
+
+    def resolved(future):
+      if closed():
+        return
+      try:
+        add(future.result())
+      except Exception as e:
+        finish_stream(e)
+        return
+      next_item()
+
+    def next_item():
+      while not closed():
+        try:
+          item = iterator.next()
+        except StopIteration:
+          finish_stream()
+          return
+        except Exception as e:
+          finish_stream(e)
+          return
+        if isinstance(item, Future):
+          item.add_done_callback(lambda f: io_loop.add_callback(lambda: resolved(f)))
+          return
+        add(item)
+        if state['size'] >= self.STREAM_BUFFER_SIZE:
+          flush_stream(next_item)
+          return
+
+    if streaming:
+      self.add_header('content-type', self.response_type)
+      self.set_header('Transfer-Encoding', 'chunked')
+      if signature:
+        self.set_header('Trailer', 'x-toto-hmac')
+      if self.application.settings.get('gzip'):
+        self.set_header('Content-Encoding', 'identity')
+      session = self.__session_data()
+      send(session and '{"session": %s, "result": [' % dumps(session) or '{"result": [')
+      flush_stream()
+    next_item()
+
+  def __session_data(self):
+    return self.session and {'session_id': self.session.session_id, 'expires': self.session.expires, 'user_id': str(self.session.user_id)} or None
+
   def respond(self, result=None, error=None, batch_results=None):
     '''Respond to the request with the given result or error object (the ``batch_results`` parameter
     is for internal use only and not intendented to be supplied manually). Responses will be
-    serialized according to the ``response_type`` propery. The default serialization is
-    "application/json". Other supported protocols are:
+    serialized with the ``toto.serialization`` codec matching the ``response_type`` property. The default serialization is
+    "application/json". Other codecs can be enabled with the ``http_codecs`` option, including:
 
-    * application/bson - requires pymongo
-    * application/msgpack - requires msgpack-python
+    * application/bson - requires pymongo (or set ``bson_enabled``)
+    * application/msgpack - requires msgpack-python (or set ``msgpack_enabled``)
+
+    Clients select the response serialization with the "accept" header, or by sending the request in that format.
 
     The response will also contain any available session information.
     
@@ -256,15 +478,14 @@ class TotoHandler(RequestHandler):
     if batch_results:
       response['batch'] = batch_results
     if self.session:
-      response['session'] = {'session_id': self.session.session_id, 'expires': self.session.expires, 'user_id': str(self.session.user_id)}
-    if self.response_type == 'application/bson':
-      response_body = str(self.bson.encode(response))
-    elif self.response_type == 'application/msgpack':
-      response_body = self.msgpack.dumps(response)
-    else:
-      response_body = json.dumps(response)
+      response['session'] = self.__session_data()
+    start = time()
+    response_body = (codec_for_content_type(self.response_type) or get_codec('json')).dumps(response)
+    self.timer.add('serialize', start)
     if self.session:
-      self.add_header('x-toto-hmac', base64.b64encode(hmac.new(str(self.session.user_id).lower(), response_body, hashlib.sha1).digest()))
+      start = time()
+      self.add_header('x-toto-hmac', HMACSigner.instance().sign(str(self.session.user_id).lower(), response_body))
+      self.timer.add('hmac', start)
     self.respond_raw(response_body, self.response_type)
 
   def respond_raw(self, body, content_type, finish=True):
@@ -273,11 +494,14 @@ class TotoHandler(RequestHandler):
     Use finish to specify whether or not the response stream should be closed after body is written. Use ``finish=False``
     to send the response in multiple calls to ``respond_raw``.
     '''
+    self.timer.begin('write')
     self.add_header('content-type', content_type)
     if not self.headers_only:
       self.write(body)
     if finish:
       self.finish()
+    else:
+      self.timer.end('write')
 
   def on_connection_close(self):
     '''You should not call this method directly, but if you implement an ``on_connection_close()`` function in a
@@ -295,16 +519,19 @@ class TotoHandler(RequestHandler):
         method.on_connection_close(self);
     self.on_finish()
 
-  def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False):
+  def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False, since=None):
     '''If using Toto's event framework, this method makes it easy to register an event callback tied to the
     current connection and handler. Event handlers registered via this method will not be called once this handler
     has finished (connection closed). The ``deregister_on_finish`` parameter will cause this handler to be explicitly
     deregisted as part of the ``handler.on_finish`` event. Otherwise, event handlers are only cleaned up when the
     associated event is received.
 
+    Pass the last sequence number the client received as ``since`` to replay missed events from the event backlog, see
+    ``toto.events.EventManager.register_handler()``.
+
     The return value can be used to manually deregister the event handler at a later point.
     '''
-    sig = TotoHandler.event_manager.instance().register_handler(event_name, handler, run_on_main_loop, self)
+    sig = TotoHandler.event_manager.instance().register_handler(event_name, handler, run_on_main_loop, self, since=since)
     if deregister_on_finish:
       self.registered_event_handlers.append(sig)
     return sig
@@ -315,26 +542,90 @@ class TotoHandler(RequestHandler):
     TotoHandler.event_manager.instance().remove_handler(sig)
     self.registered_event_handlers.remove(sig)
 
+  def _store_session(self, session):
+    self.session = session
+    return session
+
+  def _session_id(self):
+    headers = self.request.headers
+    return 'x-toto-session-id' in headers and headers['x-toto-session-id'] or None
+
+  def _fetch_session(self, session_id):
+    headers = self.request.headers
+    start = time()
+    return self.timer.measure('session', start, self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, self.request.body))
+
   def create_session(self, user_id=None, password=None):
     '''Create a new session for the given user id and password (or an anonymous session if ``user_id`` is ``None``).
     After this method is called, the session will be available via ``self.session``.
+
+    If the database connection is asynchronous (see ``toto.asyncdbconnection``), a ``toto.futures.Future`` will be
+    returned instead and ``self.session`` will be set when it resolves.
     '''
-    self.session = self.db_connection.create_session(user_id, password)
-    return self.session
+    start = time()
+    return then(self.timer.measure('session', start, self.db_connection.create_session(user_id, password)), self._store_session)
 
   def retrieve_session(self, session_id=None):
     '''Retrieve the session specified by the request headers (or if enabled, the request cookie) and store it
     in ``self.session``. Alternatively, pass a ``session_id`` to this function to retrieve that session explicitly.
+
+    If the database connection is asynchronous (see ``toto.asyncdbconnection``), a ``toto.futures.Future`` will be
+    returned instead and ``self.session`` will be set when it resolves.
     '''
     if not self.session or (session_id and self.session.session_id != session_id):
-      headers = self.request.headers
-      if not session_id and 'x-toto-session-id' in headers:
-        session_id = 'x-toto-session-id' in headers and headers['x-toto-session-id'] or None
+      session_id = session_id or self._session_id()
       if session_id:
-        self.session = self.db_connection.retrieve_session(session_id, 'x-toto-hmac' in headers and headers['x-toto-hmac'] or None, self.request.body)
-    return self.session
+        return then(self._fetch_session(session_id), self._store_session)
+    return self._store_session(self.session)
     
   def on_finish(self):
+    self.timer.finish()
     while self.registered_event_handlers:
       self.deregister_event_handler(self.registered_event_handlers[0])
 
+
+class BatchItemHandler(object):
+  '''Passed to methods in place of the ``TotoHandler`` when they are invoked as part of a batch request. All
+  attributes are shared with the underlying handler, but ``respond()``, ``respond_raw()`` and ``finish()`` complete
+  the method's item in the batch instead of the request. This allows ``@asynchronous`` methods to run concurrently
+  in a batch.
+
+  Each item has its own ``session``, starting with the session resolved from the request headers for the whole batch,
+  so items that retrieve or create a different session do not affect the others.
+  '''
+
+  LOCAL_ATTRIBUTES = {'response_type', 'session'}
+
+  def __init__(self, handler, callback):
+    object.__setattr__(self, '_batch_handler', handler)
+    object.__setattr__(self, '_batch_callback', callback)
+    object.__setattr__(self, 'session', handler.session)
+
+  def __getattr__(self, name):
+    return getattr(self._batch_handler, name)
+
+  def __setattr__(self, name, value):
+    if name in self.LOCAL_ATTRIBUTES:
+      object.__setattr__(self, name, value)
+    else:
+      setattr(self._batch_handler, name, value)
+
+  def _store_session(self, session):
+    self.session = session
+    return session
+
+  def retrieve_session(self, session_id=None):
+    return type(self._batch_handler).retrieve_session.im_func(self, session_id)
+
+  def create_session(self, user_id=None, password=None):
+    return type(self._batch_handler).create_session.im_func(self, user_id, password)
+
+  def respond(self, result=None, error=None, batch_results=None):
+    self._batch_callback(result, error)
+
+  def respond_raw(self, body, content_type, finish=True):
+    if finish:
+      self._batch_callback(body, None)
+
+  def finish(self):
+    self._batch_callback(None, None)
@@ -1,12 +1,22 @@
 '''``toto.invocation`` contains many decorators that may be applied to the ``invoke(handler, parameters)`` functions in
   method modules in order to modify their behavior.
+
+  Decorators that load sessions work with both blocking and asynchronous database connections. With an asynchronous
+  connection, the decorated function will return a ``toto.futures.Future`` that ``TotoHandler`` will respond with
+  when it resolves.
 '''
 
 from exceptions import *
-from tornado.options import options
+from futures import Future, then
+from serialization import get_codec
+from tasks import TaskQueue, QueueFullError
+from tornado.options import define, options
+from tornado.ioloop import IOLoop
 from traceback import format_exc
+from collections import OrderedDict
+from threading import Lock
+from time import time
 import logging
-import json
 
 """
 This is a list of all attributes that may be added by a decorator,
@@ -14,6 +24,9 @@ it is used to allow decorators to be order agnostic.
 """
 invocation_attributes = ['asynchronous', '__doc__', '__repr__']
 
+define("method_threads", default=4, help="The number of threads in the shared pool used by methods decorated with @threaded")
+define("method_queue_size", default=0, help="The maximum number of requests that may wait for the shared @threaded pool before new requests are rejected as busy, or zero for no limit")
+
 def __copy_attributes(fn, wrapper):
   for a in invocation_attributes:
     if hasattr(fn, a):
@@ -27,6 +40,97 @@ def asynchronous(fn):
   fn.asynchronous = True
   return fn
 
+def threaded(thread_count=0, max_queue=0):
+  '''Invoke functions marked with the ``@threaded`` decorator will run on a thread pool instead of Tornado's
+  ``IOLoop`` so CPU intensive or blocking methods do not stall other requests. The request will be finished
+  with the function's return value on the ``IOLoop`` once it completes.
+
+  By default, the pool shared by all ``@threaded`` methods will be used. Its size and queue limit are set with the
+  ``method_threads`` and ``method_queue_size`` options. Pass ``thread_count`` to limit the method to its own pool of
+  ``thread_count`` threads, and ``max_queue`` to limit the number of requests that may wait for that pool::
+
+    @threaded(2, max_queue=50)
+    def invoke(handler, parameters):
+      #do blocking work
+
+  Requests that arrive when the queue is full will fail with ``ERROR_SERVER_BUSY``. Queue depths and counts are available
+  from ``toto.tasks.TaskQueue.instance_stats()``.
+
+  Note: ``@threaded`` should usually be the last decorator in the chain, as the decorated function must not write
+  to the handler directly. Decorators before it (e.g. ``@authenticated``) will still run on the ``IOLoop``.
+  '''
+  def decorator(fn):
+    queue_name = thread_count and 'toto.invocation.threaded.%s' % fn.__module__ or 'toto.invocation.threaded'
+    def wrapper(handler, parameters):
+      queue = TaskQueue.instance(queue_name, thread_count or options.method_threads, IOLoop.instance(), max_queue if thread_count else options.method_queue_size)
+      try:
+        return queue.submit(fn, handler, parameters)
+      except QueueFullError as e:
+        raise TotoException(ERROR_SERVER_BUSY, "Server busy")
+    __copy_attributes(fn, wrapper)
+    return wrapper
+
+  if isinstance(thread_count, (int, long)):
+    return decorator
+  fn = thread_count
+  thread_count = 0
+  return decorator(fn)
+
+def _freeze(value):
+  if isinstance(value, dict):
+    return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+  if isinstance(value, (list, tuple)):
+    return tuple(_freeze(v) for v in value)
+  if isinstance(value, set):
+    return frozenset(_freeze(v) for v in value)
+  return value
+
+def memoize(ttl=60, max_size=1000):
+  '''Invoke functions marked with the ``@memoize`` decorator will return a stored result instead of running again when
+  called with equal parameters within ``ttl`` seconds. Up to ``max_size`` results are kept, discarding the least recently
+  used. This is intended for expensive worker methods and other methods whose result depends only on their parameters,
+  it should not be used with ``@asynchronous`` methods or methods that depend on the session::
+
+    @memoize(ttl=300, max_size=100)
+    def invoke(worker, parameters):
+      #build an expensive report
+
+  Results that are ``toto.futures.Future`` instances are stored until they fail. Parameters must be dictionaries, lists,
+  sets and hashable values.
+  '''
+  def decorator(fn):
+    results = OrderedDict()
+    lock = Lock()
+    def wrapper(handler, parameters):
+      key = _freeze(parameters)
+      now = time()
+      with lock:
+        cached = results.pop(key, None)
+        if cached and cached[0] > now:
+          results[key] = cached
+          return cached[1]
+      result = fn(handler, parameters)
+      with lock:
+        results[key] = (now + ttl, result)
+        while len(results) > max_size:
+          results.popitem(False)
+      if isinstance(result, Future):
+        def evict(f):
+          if f.exc_info():
+            with lock:
+              if key in results and results[key][1] is f:
+                del results[key]
+        result.add_done_callback(evict)
+      return result
+    __copy_attributes(fn, wrapper)
+    return wrapper
+
+  if isinstance(ttl, (int, long, float)):
+    return decorator
+  fn = ttl
+  ttl = 60
+  return decorator(fn)
+
 def anonymous_session(fn):
   '''Invoke functions marked with the ``@anonymous_session`` decorator will attempt to load
   the current session (either referenced by the x-toto-session-id request headers or cookie).
@@ -36,10 +140,11 @@ def anonymous_session(fn):
   will be loaded.
   '''
   def wrapper(handler, parameters):
-    handler.retrieve_session()
-    if not handler.session:
-      handler.create_session()
-    return fn(handler, parameters)
+    def check_session(session):
+      if not session:
+        return then(handler.create_session(), lambda session: fn(handler, parameters))
+      return fn(handler, parameters)
+    return then(handler.retrieve_session(), check_session)
   __copy_attributes(fn, wrapper)
   return wrapper
 
@@ -50,10 +155,11 @@ def authenticated(fn):
   error will be returned to the client.
   '''
   def wrapper(handler, parameters):
-    handler.retrieve_session()
-    if not handler.session or not handler.session.user_id:
-      raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    return fn(handler, parameters)
+    def check_session(session):
+      if not session or not session.user_id:
+        raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
+      return fn(handler, parameters)
+    return then(handler.retrieve_session(), check_session)
   __copy_attributes(fn, wrapper)
   return wrapper
 
@@ -63,8 +169,7 @@ def optionally_authenticated(fn):
   If no session is found, the request proceeds as usual.
   '''
   def wrapper(handler, parameters):
-    handler.retrieve_session()
-    return fn(handler, parameters)
+    return then(handler.retrieve_session(), lambda session: fn(handler, parameters))
   __copy_attributes(fn, wrapper)
   return wrapper
 
@@ -74,12 +179,15 @@ def authenticated_with_parameter(fn):
   parameter to find the current session instead of the x-toto-session-id header or cookie.
   '''
   def wrapper(handler, parameters):
+    def check_session(session):
+      if not session:
+        raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
+      return fn(handler, parameters)
     if 'session_id' in parameters:
-      handler.retrieve_session(parameters['session_id'])
+      session = handler.retrieve_session(parameters['session_id'])
       del parameters['session_id']
-    if not handler.session:
-      raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    return fn(handler, parameters)
+      return then(session, check_session)
+    return check_session(handler.session)
   __copy_attributes(fn, wrapper)
   return wrapper
 
@@ -111,8 +219,10 @@ def raw_response(fn):
   '''
   def wrapper(handler, parameters):
     handler.response_type = 'application/octet-stream'
-    handler.respond_raw(fn(handler, parameters), handler.response_type)
-    return None
+    def respond(result):
+      handler.respond_raw(result, handler.response_type)
+      return None
+    return then(fn(handler, parameters), respond)
   __copy_attributes(fn, wrapper)
   return wrapper
 
@@ -141,8 +251,10 @@ def jsonp(callback_name='jsonp'):
       callback = parameters.get(callback_name, None)
       if callback:
         del parameters[callback_name]
-        handler.respond_raw('%s(%s)' % (callback, json.dumps(fn(handler, parameters))), 'text/javascript')
-        return None
+        def respond(result):
+          handler.respond_raw('%s(%s)' % (callback, get_codec('json').dumps(result)), 'text/javascript')
+          return None
+        return then(fn(handler, parameters), respond)
       else:
         return fn(handler, parameters)
     __copy_attributes(fn, wrapper)
@@ -169,9 +281,7 @@ def error_redirect(redirect_map, default=None):
   '''
   def decorator(fn):
     def wrapper(handler, parameters):
-      try:
-        return fn(handler, parameters)
-      except Exception as e:
+      def redirect(e):
         if options.debug:
           logging.error(format_exc())
         if hasattr(e, 'code') and str(e.code) in redirect_map:
@@ -182,6 +292,13 @@ def error_redirect(redirect_map, default=None):
           handler.redirect(default)
         else:
           raise
+      try:
+        result = fn(handler, parameters)
+      except Exception as e:
+        return redirect(e)
+      if isinstance(result, Future):
+        return then(result, None, redirect)
+      return result
     __copy_attributes(fn, wrapper)
     return wrapper
   return decorator
@@ -1,4 +1,5 @@
 from toto.invocation import *
+from toto.futures import then
 
 @requires('user_id', 'password')
 def invoke(handler, params):
@@ -7,5 +8,4 @@ def invoke(handler, params):
 
   Requires: ``user_id``, ``password``
   '''
-  handler.create_session(params['user_id'], params['password'])
-  return {'session_id': handler.session.session_id, 'expires': handler.session.expires, 'user_id': handler.session.user_id}
+  return then(handler.create_session(params['user_id'], params['password']), lambda session: {'session_id': session.session_id, 'expires': session.expires, 'user_id': session.user_id})
@@ -1,19 +1,24 @@
-import toto.methods.account.login
+import login
 from toto.invocation import *
+from toto.futures import then
 
 @authenticated
 def invoke(handler, params):
   result = {'updated_fields': []}
+  login_result = None
   if 'new_password' in params:
     handler.db_connection.change_password(params['user_id'], params['password'], params['new_password'])
     result['updated_fields'].append('password')
-    result.update(login.invoke(handler, {'user_id': params['user_id'], 'password': params['new_password']}))
+    login_result = login.invoke(handler, {'user_id': params['user_id'], 'password': params['new_password']})
     del params['new_password']
   del params['password']
-  account = handler.session.get_account()
-  for k in params:
-    account[k] = params[k]
-    result['updated_fields'].append(k)
-    account.save()
-  return result
-  
+  def update_account(login_result):
+    if login_result:
+      result.update(login_result)
+    account = handler.session.get_account()
+    for k in params:
+      account[k] = params[k]
+      result['updated_fields'].append(k)
+      account.save()
+    return result
+  return then(login_result, update_account)
@@ -0,0 +1,44 @@
+from toto.profiling import Profiler
+from toto.tasks import TaskQueue
+from toto.invocation import *
+from toto.signing import compare_digest
+from tornado.options import options
+
+@authenticated
+def invoke(handler, params):
+  '''Returns the request timing histograms recorded by ``toto.profiling`` as "requests" and the state of each shared
+  ``TaskQueue`` as "task_queues". If the event system is enabled, ``toto.events.EventManager.stats()`` is returned as
+  "events". Profiling must be enabled with the ``request_profiling`` or ``slow_request_threshold`` option for request
+  timings to be recorded. This method exposes internal information about the server, so it requires an authenticated
+  session and the secret configured with the ``stats_key`` option. It is refused if ``stats_key`` is not set. It is
+  not imported by ``toto.methods``, so add it to your method module explicitly::
+
+    import toto.methods.stats as stats
+
+  Required parameters:
+
+  * ``key`` - The value of the ``stats_key`` option.
+
+  Optional parameters:
+
+  * ``method`` - Only return timings for this method, by its dotted name (e.g. "account.login").
+  * ``reset`` - If ``True``, clear the recorded timings and event statistics after reading them.
+  '''
+  key = params.get('key') or ''
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  if not options.stats_key or not compare_digest(options.stats_key, str(key)):
+    raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
+  requests = Profiler.instance_stats()
+  if 'method' in params:
+    method = params['method'].replace('/', '.')
+    requests = {name: {k: v for k, v in stats.iteritems() if k == method} for name, stats in requests.iteritems()}
+  stats = {'requests': requests, 'task_queues': TaskQueue.instance_stats()}
+  event_manager = getattr(handler, 'event_manager', None)
+  if event_manager:
+    stats['events'] = event_manager.instance().stats()
+  if params.get('reset'):
+    Profiler.reset_instances()
+    if event_manager:
+      event_manager.instance().reset_stats()
+  return stats
@@ -5,10 +5,8 @@ from time import time
 from datetime import datetime
 import base64
 import uuid
-import hmac
-import hashlib
-import cPickle as pickle
 import toto.secret as secret
+from toto.signing import HMACSigner
 from dbconnection import DBConnection
 
 class MongoDBSession(TotoSession):
@@ -33,7 +31,7 @@ class MongoDBSession(TotoSession):
   def save(self):
     if not self._verified:
       raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    self._db.sessions.update({'session_id': self.session_id}, {'$set': {'state': pickle.dumps(self.state)}})
+    self._db.sessions.update({'session_id': self.session_id}, {'$set': {'state': self.serialized_state()}})
 
 class MongoDBConnection(DBConnection):
 
@@ -85,14 +83,19 @@ class MongoDBConnection(DBConnection):
       return None
     user_id = session_data['user_id']
     if session_data['expires'] < (time() + (user_id and self.session_renew or self.anon_session_renew)):
-      session_data['expires'] = time() + (user_id and self.session_ttl or self.anon_session_ttl)
-      self.db.sesions.update({'session_id': session_id}, {'$set': {'expires': session_data['expires']}})
+      ttl = user_id and self.session_ttl or self.anon_session_ttl
+      session_data['expires'] = time() + ttl
+      self._renew_session(session_id, ttl)
     session = MongoDBSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if data and not HMACSigner.instance().verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, renewals):
+    for ttl, session_ids in renewals.iteritems():
+      self.db.sessions.update({'session_id': {'$in': session_ids}}, {'$set': {'expires': time() + ttl}}, multi=True)
+
   def remove_session(self, session_id):
     self.db.sessions.remove({'session_id': session_id})
 
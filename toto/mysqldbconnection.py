@@ -6,13 +6,11 @@ from datetime import datetime
 from dbconnection import DBConnection
 from uuid import uuid4
 import toto.secret as secret
+from toto.signing import HMACSigner
 import base64
 import uuid
-import hmac
-import hashlib
 import random
 import string
-import cPickle as pickle
 
 class MySQLdbSession(TotoSession):
   _account = None
@@ -49,7 +47,7 @@ class MySQLdbSession(TotoSession):
   def save(self):
     if not self._verified:
       raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    self._db.execute("update session set state = %s where session_id = %s", pickle.dumps(self.state), self.session_id)
+    self._db.execute("update session set state = %s where session_id = %s", self.serialized_state(), self.session_id)
 
 class MySQLdbConnection(DBConnection):
 
@@ -116,14 +114,19 @@ class MySQLdbConnection(DBConnection):
       return None
     user_id = session_data['user_id']
     if session_data['expires'] < (time() + (user_id and self.session_renew or self.anon_session_renew)):
-      session_data['expires'] = time() + (user_id and self.session_ttl or self.anon_session_ttl)
-      self.db.execute("update session set expires = %s where session_id = %s", session_data['expires'], session_id)
+      ttl = user_id and self.session_ttl or self.anon_session_ttl
+      session_data['expires'] = time() + ttl
+      self._renew_session(session_id, ttl)
     session = MySQLdbSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if data and not HMACSigner.instance().verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, renewals):
+    for ttl, session_ids in renewals.iteritems():
+      self.db.execute("update session set expires = %s where session_id in (" + ','.join(['%s' for i in session_ids]) + ")", *([time() + ttl] + session_ids))
+
   def remove_session(self, session_id):
     self.db.execute("delete from session where session_id = %s", session_id)
 
@@ -5,11 +5,9 @@ from datetime import datetime
 from psycopg2.pool import ThreadedConnectionPool
 from itertools import izip
 import toto.secret as secret
-import cPickle as pickle
+from toto.signing import HMACSigner
 import base64
 import uuid
-import hmac
-import hashlib
 import random
 import string
 from dbconnection import DBConnection
@@ -77,7 +75,7 @@ class PostgresSession(TotoSession):
   def save(self):
     if not self._verified:
       raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    self._db.execute("update session set state = %s where session_id = %s", (pickle.dumps(self.state), self.session_id))
+    self._db.execute("update session set state = %s where session_id = %s", (self.serialized_state(), self.session_id))
 
 class PostgresConnection(DBConnection):
 
@@ -136,14 +134,19 @@ class PostgresConnection(DBConnection):
       return None
     user_id = session_data['user_id']
     if session_data['expires'] < (time() + (user_id and self.session_renew or self.anon_session_renew)):
-      session_data['expires'] = time() + (user_id and self.session_ttl or self.anon_session_ttl)
-      self.db.execute("update session set expires = %s where session_id = %s", (session_data['expires'], session_id))
+      ttl = user_id and self.session_ttl or self.anon_session_ttl
+      session_data['expires'] = time() + ttl
+      self._renew_session(session_id, ttl)
     session = PostgresSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if data and not HMACSigner.instance().verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, renewals):
+    for ttl, session_ids in renewals.iteritems():
+      self.db.execute("update session set expires = %s where session_id in (" + ','.join(['%s' for i in session_ids]) + ")", [time() + ttl] + session_ids)
+
   def remove_session(self, session_id):
     self.db.execute("delete from session where session_id = %s", (session_id,))
 
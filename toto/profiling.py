@@ -0,0 +1,227 @@
+'''``toto.profiling`` records how long each phase of a request takes so latency can be diagnosed without adding timers to
+method modules. Enable it with the ``request_profiling`` option, or set ``slow_request_threshold`` to log the phases of
+slow requests.
+
+``TotoHandler`` records these phases for each request:
+
+* ``parse`` - decoding the request body
+* ``session`` - creating or retrieving the session
+* ``invoke`` - running the method, excluding ``session``. Methods that return a ``toto.futures.Future`` are timed until it
+  resolves, only the synchronous part of ``@asynchronous`` methods is included
+* ``serialize`` - serializing the response
+* ``hmac`` - signing the response
+* ``write`` - writing the response to the connection
+* ``total`` - the time from the start of the request until it finished
+
+``TotoSocketHandler`` records ``parse``, ``session``, ``invoke`` and ``total`` for each message. Timings are
+aggregated per method into histograms. Use ``Profiler.instance_stats()`` or the built in ``toto.methods.stats``
+method to read them.
+'''
+
+from tornado.options import define, options
+from threading import Lock
+from time import time
+from math import log
+from toto.futures import Future
+import logging
+
+define("request_profiling", default=False, help="Record per phase timing histograms for every request. See toto.profiling")
+define("slow_request_threshold", default=0.0, help="Log the phase timings of requests that take longer than this many seconds, or zero to disable")
+define("stats_key", default=None, type=str, help="The secret that clients must pass as the \"key\" parameter to the built in toto.methods.stats method. If not set, the method refuses all requests")
+
+class Histogram(object):
+  '''Counts samples in logarithmic buckets that are ``Histogram.FACTOR`` times wider than the previous bucket, starting
+  at ``Histogram.MINIMUM`` seconds. Percentiles are accurate to within one bucket (10% by default).
+  '''
+
+  FACTOR = 1.1
+  MINIMUM = 0.00001
+  _LOG_FACTOR = log(FACTOR)
+
+  def __init__(self):
+    self.buckets = {}
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, value):
+    bucket = value > self.MINIMUM and int(log(value / self.MINIMUM) / self._LOG_FACTOR) + 1 or 0
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def percentile(self, percent):
+    '''Returns the upper bound of the bucket containing the ``percent`` percentile sample, or ``0`` if there are no samples.
+    '''
+    target = self.count * percent / 100.0
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= target:
+        return min(self.MINIMUM * self.FACTOR ** bucket, self.max)
+    return self.max
+
+  def stats(self):
+    '''Returns a dictionary with the "count" of samples and the "mean", "p50", "p95", "p99" and "max" in milliseconds.
+    '''
+    if not self.count:
+      return {'count': 0}
+    return {'count': self.count, 'mean': self.total * 1000 / self.count, 'p50': self.percentile(50) * 1000,
+        'p95': self.percentile(95) * 1000, 'p99': self.percentile(99) * 1000, 'max': self.max * 1000}
+
+class Profiler(object):
+  '''Aggregates request timings by method name and phase. Requests that take longer than ``slow_threshold`` seconds are
+  logged if ``slow_threshold`` is set. Instances are safe to use from multiple threads.
+  '''
+
+  def __init__(self, name='http', slow_threshold=0):
+    self.name = name
+    self.slow_threshold = slow_threshold
+    self.__methods = {}
+    self.__lock = Lock()
+
+  def timer(self):
+    '''Returns a new ``RequestTimer`` that will report to this profiler.
+    '''
+    return RequestTimer(self)
+
+  def record(self, method, phases, total):
+    '''Add the ``phases`` dictionary of phase durations and the ``total`` duration (in seconds) of a request for ``method``.
+    '''
+    if self.slow_threshold and total > self.slow_threshold:
+      logging.warning('Slow %s request: %s %.1fms (%s)' % (self.name, method, total * 1000, ', '.join('%s: %.1fms' % (k, v * 1000) for k, v in sorted(phases.iteritems()))))
+    with self.__lock:
+      histograms = self.__methods.get(method)
+      if histograms is None:
+        histograms = self.__methods[method] = {}
+      for phase, duration in phases.iteritems():
+        histogram = histograms.get(phase)
+        if histogram is None:
+          histogram = histograms[phase] = Histogram()
+        histogram.add(duration)
+      histogram = histograms.get('total')
+      if histogram is None:
+        histogram = histograms['total'] = Histogram()
+      histogram.add(total)
+
+  def stats(self):
+    '''Returns a dictionary mapping each method name to a dictionary of ``Histogram.stats()`` for each phase.
+    '''
+    with self.__lock:
+      return {method: {phase: histogram.stats() for phase, histogram in histograms.iteritems()} for method, histograms in self.__methods.iteritems()}
+
+  def reset(self):
+    '''Discard all recorded timings.
+    '''
+    with self.__lock:
+      self.__methods.clear()
+
+  @classmethod
+  def instance(cls, name='http'):
+    '''Returns the shared ``Profiler`` stored under ``name``, creating it with the ``slow_request_threshold`` option on the
+    first call.
+    '''
+    if not hasattr(cls, '_profilers'):
+      cls._profilers = {}
+    try:
+      return cls._profilers[name]
+    except KeyError:
+      cls._profilers[name] = cls(name, options.slow_request_threshold)
+      return cls._profilers[name]
+
+  @classmethod
+  def instance_stats(cls):
+    '''Returns a dictionary mapping the name of each shared instance to its ``stats()``.
+    '''
+    return {name: profiler.stats() for name, profiler in getattr(cls, '_profilers', {}).iteritems()}
+
+  @classmethod
+  def reset_instances(cls):
+    '''Calls ``reset()`` on each shared instance.
+    '''
+    for profiler in getattr(cls, '_profilers', {}).itervalues():
+      profiler.reset()
+
+  @classmethod
+  def enabled(cls):
+    '''Returns ``True`` if either the ``request_profiling`` or ``slow_request_threshold`` option is set.
+    '''
+    return bool(options.request_profiling or options.slow_request_threshold)
+
+class RequestTimer(object):
+  '''Collects the phase timings of a single request and reports them to ``profiler`` when ``finish()`` is called. ``method``
+  should be set to the name of the invoked method.
+  '''
+
+  def __init__(self, profiler):
+    self.profiler = profiler
+    self.method = None
+    self.phases = {}
+    self.start_time = time()
+    self.finished = False
+    self.__started = {}
+
+  def add(self, phase, start):
+    '''Add the time since ``start`` to ``phase``.
+    '''
+    self.phases[phase] = self.phases.get(phase, 0.0) + time() - start
+
+  def begin(self, phase):
+    '''Start timing ``phase``. The time will be added when ``end(phase)`` or ``finish()`` is called.
+    '''
+    self.__started[phase] = time()
+
+  def end(self, phase):
+    '''Add the time since ``begin(phase)`` was called to ``phase``.
+    '''
+    start = self.__started.pop(phase, None)
+    if start is not None:
+      self.add(phase, start)
+
+  def measure(self, phase, start, value=None):
+    '''Add the time since ``start`` to ``phase`` once ``value`` is available and return ``value``. If ``value`` is a
+    ``toto.futures.Future``, the time is added when it resolves.
+    '''
+    if isinstance(value, Future):
+      value.add_done_callback(lambda f: self.add(phase, start))
+    else:
+      self.add(phase, start)
+    return value
+
+  def finish(self):
+    '''Report the collected timings. Only the first call has any effect.
+    '''
+    if self.finished:
+      return
+    self.finished = True
+    for phase in self.__started.keys():
+      self.end(phase)
+    phases = self.phases
+    if 'invoke' in phases and 'session' in phases:
+      phases['invoke'] = max(phases['invoke'] - phases['session'], 0.0)
+    self.profiler.record(self.method or 'unknown', phases, time() - self.start_time)
+
+class NullTimer(object):
+  '''Used in place of ``RequestTimer`` when profiling is disabled. All methods do nothing.
+  '''
+
+  method = None
+
+  def add(self, phase, start):
+    pass
+
+  def begin(self, phase):
+    pass
+
+  def end(self, phase):
+    pass
+
+  def measure(self, phase, start, value=None):
+    return value
+
+  def finish(self):
+    pass
+
+NULL_TIMER = NullTimer()
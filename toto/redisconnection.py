@@ -5,10 +5,8 @@ from time import time
 from datetime import datetime
 import base64
 import uuid
-import hmac
-import hashlib
-import cPickle as pickle
 import toto.secret as secret
+from toto.signing import HMACSigner
 from dbconnection import DBConnection
 
 def _account_key(user_id):
@@ -39,7 +37,7 @@ class RedisSession(TotoSession):
   def save(self):
     if not self._verified:
       raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    self._db.hset(_session_key(self.session_id), 'state', pickle.dumps(self.state))
+    self._db.hset(_session_key(self.session_id), 'state', self.serialized_state())
 
 class RedisConnection(DBConnection):
   
@@ -86,13 +84,20 @@ class RedisConnection(DBConnection):
     user_id = session_data['user_id']
     ttl = (user_id and self.session_ttl or self.anon_session_ttl)
     session_data['expires'] = time() + ttl
-    self.db.expire(session_key, ttl)
+    self._renew_session(session_id, ttl)
     session = RedisSession(self.db, session_data)
-    if data and hmac_data != base64.b64encode(hmac.new(str(user_id), data, hashlib.sha1).digest()):
+    if data and not HMACSigner.instance().verify(str(user_id), data, hmac_data):
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     session._verified = True
     return session
 
+  def _renew_sessions(self, renewals):
+    pipeline = self.db.pipeline(transaction=False)
+    for ttl, session_ids in renewals.iteritems():
+      for session_id in session_ids:
+        pipeline.expire(_session_key(session_id), ttl)
+    pipeline.execute()
+
   def remove_session(self, session_id):
     session_key = _session_key(session_id)
     self.db.delete(session_key)
@@ -0,0 +1,168 @@
+'''``toto.serialization`` is the single place where Toto chooses how to serialize data. Codecs are registered by
+name and content type and are used for HTTP requests and responses, web sockets, events, workers and session state.
+
+The following codecs are built in:
+
+* ``json`` - ``application/json``, using ``ujson`` or ``simplejson`` if available, or the ``json_module`` option
+* ``msgpack`` - ``application/msgpack``, requires msgpack-python
+* ``bson`` - ``application/bson``, requires pymongo
+* ``pickle`` - ``application/x-python-pickle``, uses ``cPickle`` and is intended for internal transports only
+
+Optional dependencies are only imported when a codec is first used. Anywhere Toto accepts a codec name, the name
+of any module with ``dumps`` and ``loads`` functions may be used instead.
+
+Run ``python -m toto.serialization`` to compare the speed of the available codecs on typical Toto payloads.
+'''
+
+from tornado.options import define, options
+import cPickle as pickle
+
+define("json_module", default=None, type=str, help="The module to use for JSON serialization. By default ujson or simplejson will be used if available, falling back to json.")
+
+class Codec(object):
+  '''Instances pair a ``dumps`` and ``loads`` function with a ``name`` and ``content_type``. ``binary`` is ``True`` if the
+  serialized data is not text.
+  '''
+
+  def __init__(self, name, content_type, dumps, loads, binary=True):
+    self.name = name
+    self.content_type = content_type
+    self.dumps = dumps
+    self.loads = loads
+    self.binary = binary
+
+  def __repr__(self):
+    return '<toto.serialization.Codec %s (%s)>' % (self.name, self.content_type)
+
+_codec_factories = {}
+_codecs = {}
+_content_types = {}
+
+def register_codec(name, content_type, factory):
+  '''Register a codec as ``name`` for ``content_type``. ``factory`` will be called with no arguments the first time the codec
+  is requested and must return a ``Codec``. Registering an existing name replaces the previous codec.
+  '''
+  _codec_factories[name] = factory
+  _codecs.pop(name, None)
+  if content_type:
+    _content_types[content_type] = name
+
+def get_codec(name):
+  '''Returns the ``Codec`` registered as ``name``. If no codec matches, ``name`` is imported as a module and used as a codec
+  if it has ``dumps`` and ``loads`` functions. ``name`` may also be a module.
+  '''
+  if not isinstance(name, basestring):
+    return Codec(name.__name__, None, name.dumps, name.loads)
+  try:
+    return _codecs[name]
+  except KeyError:
+    pass
+  if name in _codec_factories:
+    codec = _codec_factories[name]()
+  else:
+    module = __import__(name, fromlist=['dumps'])
+    codec = Codec(name, None, module.dumps, module.loads)
+  _codecs[name] = codec
+  return codec
+
+def codec_for_content_type(content_type, allowed=None):
+  '''Returns the codec registered for ``content_type`` (parameters such as "charset" are ignored), or ``None`` if there
+  is no match or the codec name is not in ``allowed``.
+  '''
+  name = _content_types.get(content_type.split(';', 1)[0].strip().lower())
+  if not name or (allowed is not None and name not in allowed):
+    return None
+  return get_codec(name)
+
+def negotiate(accept, allowed=None):
+  '''Returns the first codec in the HTTP ``Accept`` header value ``accept`` that is registered (and in ``allowed``),
+  honoring "q" values. ``None`` is returned if there is no acceptable codec.
+  '''
+  if not accept:
+    return None
+  ranges = []
+  for i, item in enumerate(accept.split(',')):
+    parts = item.split(';')
+    quality = 1.0
+    for p in parts[1:]:
+      p = p.strip()
+      if p.startswith('q='):
+        try:
+          quality = float(p[2:])
+        except ValueError:
+          quality = 0.0
+    if quality > 0:
+      ranges.append((-quality, i, parts[0].strip().lower()))
+  for quality, i, content_type in sorted(ranges):
+    codec = codec_for_content_type(content_type, allowed)
+    if codec:
+      return codec
+  return None
+
+def _json_codec():
+  module = None
+  if options.json_module:
+    module = __import__(options.json_module)
+  else:
+    for name in ('ujson', 'simplejson', 'json'):
+      try:
+        module = __import__(name)
+        break
+      except ImportError:
+        pass
+  return Codec('json', 'application/json', module.dumps, module.loads, False)
+
+def _msgpack_codec():
+  import msgpack
+  return Codec('msgpack', 'application/msgpack', msgpack.dumps, msgpack.loads)
+
+def _bson_codec():
+  from bson import BSON
+  return Codec('bson', 'application/bson', lambda o: str(BSON.encode(o)), lambda s: BSON(s).decode())
+
+def _pickle_codec():
+  return Codec('pickle', 'application/x-python-pickle', lambda o: pickle.dumps(o, pickle.HIGHEST_PROTOCOL), pickle.loads)
+
+register_codec('json', 'application/json', _json_codec)
+register_codec('msgpack', 'application/msgpack', _msgpack_codec)
+register_codec('bson', 'application/bson', _bson_codec)
+register_codec('pickle', 'application/x-python-pickle', _pickle_codec)
+
+def benchmark(iterations=1000, codecs=('json', 'msgpack', 'bson', 'pickle')):
+  '''Times each codec in ``codecs`` serializing and deserializing representative Toto payloads (a method request, a
+  small response with session info, a 500 item list response and an event) ``iterations`` times. Codecs that cannot be
+  loaded are skipped. Returns a dictionary mapping ``(codec name, payload name)`` to ``(dumps seconds, loads seconds, size)``.
+  '''
+  from time import time
+  session = {'session_id': 'Zm9vYmFyYmF6cXV4cXV1eA', 'expires': 1380000000.123, 'user_id': 'user@example.com'}
+  payloads = {
+    'request': {'method': 'account.update', 'parameters': {'user_id': 'user@example.com', 'name': 'Test User', 'age': 30, 'tags': ['a', 'b', 'c']}},
+    'response': {'result': {'updated_fields': ['name', 'age'], 'ok': True}, 'session': session},
+    'list': {'result': [{'id': i, 'name': 'item %d' % i, 'score': i * 1.5, 'active': i % 2 == 0, 'tags': ['x', 'y']} for i in xrange(500)], 'session': session},
+    'event': {'name': 'message', 'args': {'from': 'user@example.com', 'text': 'hello ' * 20, 'sent': 1380000000.5}},
+  }
+  results = {}
+  for name in codecs:
+    try:
+      codec = get_codec(name)
+    except ImportError:
+      continue
+    for payload_name, payload in payloads.iteritems():
+      start = time()
+      for i in xrange(iterations):
+        data = codec.dumps(payload)
+      dumps_time = time() - start
+      start = time()
+      for i in xrange(iterations):
+        codec.loads(data)
+      loads_time = time() - start
+      results[(name, payload_name)] = (dumps_time, loads_time, len(data))
+  return results
+
+if __name__ == '__main__':
+  import sys
+  iterations = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+  results = benchmark(iterations)
+  print '%-10s %-10s %12s %12s %10s' % ('codec', 'payload', 'dumps (ms)', 'loads (ms)', 'bytes')
+  for (name, payload_name), (dumps_time, loads_time, size) in sorted(results.iteritems()):
+    print '%-10s %-10s %12.3f %12.3f %10d' % (name, payload_name, dumps_time * 1000 / iterations, loads_time * 1000 / iterations, size)
@@ -29,6 +29,7 @@ define("autoreload", default=False, help="This option autoreloads modules as cha
 define("remote_event_receivers", type=str, help="A comma separated list of remote event address that this event manager should connect to. e.g.: 'tcp://192.168.1.2:8889'", multiple=True)
 define("event_mode", default='off', metavar='off|on|only', help="This option enables or disables the event system, also providing an option to launch this server as an event server only")
 define("event_init_module", default=None, type=str, help="If defined, this module's 'invoke' function will be called with the EventManager instance after the main event handler is registered (e.g.: myevents.setup)")
+define("event_broker", default=False, help="With event_transport=pubsub, run the event broker in the first server process, listening on the ports of event_publish_address and event_subscribe_address")
 define("event_port", default=8999, help="The address to listen to event connections on - due to message queuing, servers use the next higher port as well")
 define("startup_function", default=None, type=str, help="An optional function to run on startup - e.g. module.function. The function will be called for each server instance before the server start listening as function(connection=<active database connection>, application=<tornado.web.Application>).")
 define("use_cookies", default=False, help="Select whether to use cookies for session storage, replacing the x-toto-session-id header. You must set cookie_secret if using this option and secure_cookies is not set to False")
@@ -39,6 +40,7 @@ define("socket_closed_method", default=None, type=str, help="An optional functio
 define("socket_method_module", default=None, type=str, help="The root module to use for web socket method lookup")
 define("use_web_sockets", default=False, help="Whether or not web sockets should be installed as an alternative way to call methods")
 define("socket_path", default='websocket', help="The path to use for websocket connections")
+define("socket_serialization", default='json', help="The codec (see toto.serialization) used for web socket messages. Codecs other than JSON will send binary messages")
 define("client_side_worker_path", default="", help="The path to use for client side worker connections - functionality will be disabled if this is not set.")
 
 class TotoServer(TotoService):
@@ -102,6 +104,8 @@ class TotoServer(TotoService):
       handlers.append((os.path.join(options.root, options.client_side_worker_path), ClientSideWorkerSocketHandler))
     if not options.event_mode == 'off':
       from toto.events import EventManager
+      if options.event_transport == 'pubsub' and options.event_broker and self.service_id == 0:
+        EventManager.start_broker('tcp://*:%s' % options.event_publish_address.rsplit(':', 1)[1], 'tcp://*:%s' % options.event_subscribe_address.rsplit(':', 1)[1])
       event_manager = EventManager.instance()
       event_manager.address = 'tcp://*:%s' % (options.event_port + self.service_id)
       event_manager.start_listening()
@@ -1,4 +1,4 @@
-import cPickle as pickle
+from toto.serialization import get_codec
 
 class TotoAccount(object):
   '''Instances of TotoAccount provide dictionary-like access to user account properties. Unlike
@@ -58,18 +58,24 @@ class TotoAccount(object):
 class TotoSession(object):
   '''Instances of ``TotoSession`` provide dictionary-like access to current session variables, and the current
   account (if authenticated).
+
+  Session state is serialized with ``TotoSession.state_codec`` (see ``toto.serialization``), which is set from the
+  ``session_state_serialization`` option.
   '''
+
+  state_codec = get_codec('cPickle')
+
   def __init__(self, db, session_data):
     self._db = db
     self.user_id = session_data['user_id']
     self.expires = session_data['expires']
     self.session_id = session_data['session_id']
-    self.state = 'state' in session_data and session_data['state'] and pickle.loads(str(session_data['state'])) or {}
+    self.state = 'state' in session_data and session_data['state'] and self.state_codec.loads(str(session_data['state'])) or {}
     self._verified = False
 
   def get_account(self, *args):
     '''Load the account associated with this session (if authenticated). Session properties are
-    pickled to a binary string and stored as the ``TotoSession.state`` property, so you don't need to configure your database to handle them in
+    serialized to a binary string and stored as the ``TotoSession.state`` property, so you don't need to configure your database to handle them in
     advance.
     '''
     raise Exception("Unimplemented operation: get_account")
@@ -96,6 +102,11 @@ class TotoSession(object):
   def __str__(self):
     return str({'user_id': self.user_id, 'expires': self.expires, 'id': self.session_id, 'state': self.state})
 
+  def serialized_state(self):
+    '''Returns ``state`` serialized for storage in the database.
+    '''
+    return self.state_codec.dumps(self.state)
+
   def refresh(self):
     '''Refresh the current session to the state in the database.
     '''
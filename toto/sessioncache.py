@@ -0,0 +1,149 @@
+'''``toto.sessioncache`` provides an optional in-process cache in front of ``DBConnection.retrieve_session``.
+Enable it with the ``session_cache_size`` option or by calling ``DBConnection.enable_session_cache()``.
+
+Cached sessions are copied for each request so session state can be modified safely and HMAC verification is
+still performed on every request. Sessions are invalidated when they are saved, removed, when
+``clear_sessions`` is called for their account or when the account password changes. If an ``EventManager``
+is available, invalidations are broadcast to all other servers so their caches stay consistent.
+'''
+
+from toto.exceptions import *
+from toto.signing import HMACSigner
+from collections import OrderedDict
+from threading import Lock
+from copy import copy
+from time import time
+
+class SessionCache(object):
+  '''Caches up to ``size`` sessions retrieved from ``connection`` for ``ttl`` seconds. The least recently used
+  session is dropped when the cache is full. ``connection.retrieve_session``, ``connection.remove_session``,
+  ``connection.clear_sessions`` and ``connection.change_password`` will be replaced with cached versions.
+
+  If ``event_manager`` is set, invalidations will be sent to all registered servers as
+  ``SessionCache.INVALIDATE_EVENT`` events and received invalidations will be applied to this cache.
+  '''
+
+  INVALIDATE_EVENT = 'toto.sessioncache.invalidate'
+
+  def __init__(self, connection, size=1000, ttl=5, event_manager=None):
+    self.connection = connection
+    self.size = size
+    self.ttl = ttl
+    self.event_manager = event_manager
+    self.__sessions = OrderedDict()
+    self.__user_sessions = {}
+    self.__lock = Lock()
+    self.__retrieve_session = connection.retrieve_session
+    self.__remove_session = connection.remove_session
+    self.__clear_sessions = connection.clear_sessions
+    self.__change_password = connection.change_password
+    connection.retrieve_session = self.retrieve_session
+    connection.remove_session = self.remove_session
+    connection.clear_sessions = self.clear_sessions
+    connection.change_password = self.change_password
+    if event_manager:
+      event_manager.register_handler(self.INVALIDATE_EVENT, self.__receive_invalidation, persist=True)
+
+  def __len__(self):
+    return len(self.__sessions)
+
+  def __receive_invalidation(self, args):
+    self.invalidate(args.get('session_id'), args.get('user_id'), False)
+
+  def __wrap_save(self, session):
+    save = session.save
+    def cached_save():
+      save()
+      self.invalidate(session.session_id)
+    session.save = cached_save
+    return session
+
+  def __drop(self, session_id):
+    entry = self.__sessions.pop(session_id, None)
+    if entry:
+      user_key = str(entry[0].user_id).lower()
+      user_sessions = self.__user_sessions.get(user_key)
+      if user_sessions:
+        user_sessions.discard(session_id)
+        if not user_sessions:
+          del self.__user_sessions[user_key]
+
+  def get(self, session_id):
+    '''Returns a copy of the cached session matching ``session_id`` or ``None`` if the session is not
+    cached or its cache entry has expired. The returned session has not been verified.
+    '''
+    with self.__lock:
+      entry = self.__sessions.get(session_id)
+      if not entry:
+        return None
+      now = time()
+      if entry[2] < now or entry[0].expires < now:
+        self.__drop(session_id)
+        return None
+      del self.__sessions[session_id]
+      self.__sessions[session_id] = entry
+    session = copy(entry[0])
+    session.state = session.state_codec.loads(entry[1])
+    return session
+
+  def put(self, session):
+    '''Store a snapshot of ``session`` in the cache.
+    '''
+    template = copy(session)
+    template.__dict__.pop('_account', None)
+    template.__dict__.pop('save', None)
+    template._verified = False
+    state = session.serialized_state()
+    user_key = str(session.user_id).lower()
+    with self.__lock:
+      self.__drop(session.session_id)
+      self.__sessions[session.session_id] = (template, state, time() + self.ttl)
+      self.__user_sessions.setdefault(user_key, set()).add(session.session_id)
+      while len(self.__sessions) > self.size:
+        self.__drop(next(iter(self.__sessions)))
+
+  def invalidate(self, session_id=None, user_id=None, broadcast=True):
+    '''Remove the session matching ``session_id`` and all sessions belonging to ``user_id`` from the
+    cache. If ``broadcast`` is ``True`` and this cache was created with an ``event_manager``, the
+    invalidation will be sent to all registered servers.
+    '''
+    with self.__lock:
+      if session_id:
+        self.__drop(session_id)
+      if user_id:
+        for cached_id in list(self.__user_sessions.get(str(user_id).lower(), ())):
+          self.__drop(cached_id)
+    if broadcast and self.event_manager:
+      self.event_manager.send(self.INVALIDATE_EVENT, {'session_id': session_id, 'user_id': user_id})
+
+  def clear(self):
+    '''Remove all sessions from the local cache.
+    '''
+    with self.__lock:
+      self.__sessions.clear()
+      self.__user_sessions.clear()
+
+  def retrieve_session(self, session_id, hmac_data=None, data=None):
+    session = self.get(session_id)
+    if not session:
+      session = self.__retrieve_session(session_id, hmac_data, data)
+      if session:
+        self.put(session)
+        self.__wrap_save(session)
+      return session
+    if data and not HMACSigner.instance().verify(str(session.user_id), data, hmac_data):
+      raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
+    session._verified = True
+    return self.__wrap_save(session)
+
+  def remove_session(self, session_id):
+    self.__remove_session(session_id)
+    self.invalidate(session_id)
+
+  def clear_sessions(self, user_id):
+    self.__clear_sessions(user_id)
+    self.invalidate(user_id=user_id)
+
+  def change_password(self, user_id, password, new_password):
+    self.__change_password(user_id, password, new_password)
+    self.invalidate(user_id=user_id)
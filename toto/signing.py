@@ -0,0 +1,101 @@
+'''``toto.signing`` computes and verifies the ``x-toto-hmac`` signatures used to authenticate requests and responses.
+
+Preparing an HMAC hashes the padded key into an inner and an outer digest, so ``HMACSigner`` keeps the prepared digests
+for recently used keys and copies them for every signature instead of starting over. The digest algorithm can be changed
+with the ``hmac_digest`` option, clients must use the same algorithm.
+'''
+
+from tornado.options import define, options
+from threading import Lock
+import hashlib
+import hmac
+import base64
+
+define("hmac_digest", default='sha1', help="The hashlib digest algorithm used for x-toto-hmac signatures, e.g. sha1 or sha256")
+define("hmac_key_cache_size", default=1000, help="The number of prepared HMAC keys to keep in memory")
+
+def _compare(a, b):
+  if len(a) != len(b):
+    return False
+  result = 0
+  for x, y in zip(a, b):
+    result |= ord(x) ^ ord(y)
+  return result == 0
+
+compare_digest = getattr(hmac, 'compare_digest', _compare)
+
+class Signature(object):
+  '''An HMAC in progress, returned by ``HMACSigner.new()``. Like ``hmac.HMAC``, call ``update()`` with data to sign and
+  ``digest()`` or ``b64digest()`` for the signature.
+  '''
+
+  __slots__ = ('inner', 'outer')
+
+  def __init__(self, inner, outer):
+    self.inner = inner
+    self.outer = outer
+
+  def update(self, data):
+    self.inner.update(data)
+
+  def copy(self):
+    return Signature(self.inner.copy(), self.outer)
+
+  def digest(self):
+    outer = self.outer.copy()
+    outer.update(self.inner.digest())
+    return outer.digest()
+
+  def b64digest(self):
+    return base64.b64encode(self.digest())
+
+class HMACSigner(object):
+  '''Signs data with HMACs using the ``hashlib`` algorithm named ``digest``. The prepared inner and outer hashes for up
+  to ``cache_size`` keys are cached and copied for each new signature. Instances are safe to use from multiple threads.
+  '''
+
+  def __init__(self, digest='sha1', cache_size=1000):
+    self.digest = getattr(hashlib, digest)
+    self.cache_size = cache_size
+    self.__keys = {}
+    self.__lock = Lock()
+
+  def __prepare(self, key):
+    prepared = hmac.new(key, None, self.digest)
+    prepared = (prepared.inner, prepared.outer)
+    with self.__lock:
+      if len(self.__keys) >= self.cache_size:
+        self.__keys.clear()
+      self.__keys[key] = prepared
+    return prepared
+
+  def new(self, key, data=None):
+    '''Returns a new ``Signature`` for ``key``, optionally updated with ``data``. Call ``update()`` on the
+    returned object to sign data incrementally.
+    '''
+    prepared = self.__keys.get(key) or self.__prepare(key)
+    signature = Signature(prepared[0].copy(), prepared[1])
+    if data:
+      signature.update(data)
+    return signature
+
+  def sign(self, key, data):
+    '''Returns the base64 encoded HMAC of ``data`` with ``key``.
+    '''
+    return self.new(key, data).b64digest()
+
+  def verify(self, key, data, signature):
+    '''Returns ``True`` if ``signature`` is the base64 encoded HMAC of ``data`` with ``key``. The comparison takes the same
+    amount of time wherever the signatures differ.
+    '''
+    if not signature:
+      return False
+    return compare_digest(self.sign(key, data), str(signature))
+
+  @classmethod
+  def instance(cls):
+    '''Returns the shared ``HMACSigner`` configured with the ``hmac_digest`` and ``hmac_key_cache_size`` options.
+    '''
+    if not hasattr(cls, '_instance'):
+      cls._instance = cls(options.hmac_digest, options.hmac_key_cache_size)
+    return cls._instance
@@ -1,14 +1,21 @@
 from tornado.web import *
-import json
 from invocation import *
 from exceptions import *
 from tornado.options import define, options
 from events import EventManager
+from dispatch import DispatchTable
+from futures import then
+from serialization import get_codec
+from profiling import Profiler, NULL_TIMER
+from time import time
 from tornado.websocket import WebSocketHandler
 import logging
 
 class TotoSocketHandler(WebSocketHandler):
 
+  codec = get_codec('json')
+  profiler = None
+
   @classmethod
   def configure(cls):
     if options.debug:
@@ -20,27 +27,34 @@ class TotoSocketHandler(WebSocketHandler):
     cls._on_open = open_function and getattr(__import__(open_function[0]), open_function[1]) or None
     closed_function = options.socket_closed_method and options.socket_closed_method.rsplit('.', 1)
     cls._on_close = closed_function and getattr(__import__(closed_function[0]), closed_function[1]) or None
-    cls.__method = __import__(options.socket_method_module)
+    cls.dispatch_table = DispatchTable(__import__(options.socket_method_module))
+    cls.codec = get_codec(options.socket_serialization)
+    cls.profiler = Profiler.enabled() and Profiler.instance('socket') or None
 
   def initialize(self, db_connection):
     self.db_connection = db_connection
     self.db = self.db_connection.db
     self.session = None
     self.registered_event_handlers = []
+    self.timer = NULL_TIMER
 
   def log_error(self, e):
-    if isinstance(exception , TotoException):
+    if isinstance(e, TotoException):
       logging.error("TotoException: %s Value: %s" % (e.code, e.value))
     else:
       logging.error("TotoException: %s Value: %s" % (ERROR_SERVER, repr(e)))
   
+  def __set_session(self, session):
+    self.session = session
+    return session
+
   def create_session(self, user_id=None, password=None):
-    self.session = self.db_connection.create_session(user_id, password)
-    return self.session
+    start = time()
+    return then(self.timer.measure('session', start, self.db_connection.create_session(user_id, password)), self.__set_session)
 
   def retrieve_session(self, session_id):
-      self.session = self.db_connection.retrieve_session(session_id, None, None)
-      return self.session
+    start = time()
+    return then(self.timer.measure('session', start, self.db_connection.retrieve_session(session_id, None, None)), self.__set_session)
 
   def open(self, session_id=None):
     if session_id:
@@ -49,17 +63,24 @@ class TotoSocketHandler(WebSocketHandler):
       self._on_open()
 
   def on_message(self, message_data):
-    method = self.__method
+    timer = self.timer = self.profiler and self.profiler.timer() or NULL_TIMER
     try:
-      message = json.loads(message_data)
-      for i in message['method'].split('.'):
-        method = getattr(method, i)
-      method.invoke(self, message['parameters'])
+      start = time()
+      message = self.codec.loads(message_data)
+      timer.add('parse', start)
+      invoke = self.dispatch_table.get(message['method'])[1]
+      timer.method = message['method'].replace('/', '.')
+      start = time()
+      def failed(e):
+        timer.finish()
+        self.log_error(e)
+      then(timer.measure('invoke', start, invoke(self, message['parameters'])), lambda result: timer.finish(), failed)
     except Exception as e:
       self.log_error(e)
+      timer.finish()
 
   def send_message(self, data, message_id=None):
-    self.write_message(message_id and {'message_id': message_id, 'data': data} or data)
+    self.write_message(self.codec.dumps(message_id and {'message_id': message_id, 'data': data} or data), self.codec.binary)
 
   def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False):
     sig = EventManager.instance().register_handler(event_name, handler, run_on_main_loop, self)
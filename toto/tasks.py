@@ -5,30 +5,69 @@ run for a long time, look at Toto's worker functionality instead.
 '''
 from threading import Thread, Lock
 from collections import deque
+from toto.futures import Future
 import logging
 import traceback
+import sys
+
+class QueueFullError(Exception):
+  '''Raised when a task is added to a ``TaskQueue`` that already has ``max_queue`` tasks waiting.
+  '''
+  pass
 
 class TaskQueue():
   '''Instances will run up to ``thread_count`` tasks at a time
-  whenever there are tasks in the queue.
+  whenever there are tasks in the queue. If ``max_queue`` is set, adding
+  a task while ``max_queue`` tasks are waiting will raise ``QueueFullError``.
   '''
 
-  def __init__(self, thread_count=1):
+  def __init__(self, thread_count=1, io_loop=None, max_queue=0):
     self.tasks = deque()
     self.running = False
     self.lock = Lock()
     self.threads = set()
     self.thread_count = thread_count
-  
+    self.io_loop = io_loop
+    self.max_queue = max_queue
+    self.submitted = 0
+    self.completed = 0
+    self.rejected = 0
+    self.peak_queued = 0
+
   def add_task(self, fn, *args, **kwargs):
     '''Add the function ``fn`` to the queue to be invoked with
     ``args`` and ``kwargs`` as arguments. If the ``TaskQueue``
     is not currently running, it will be started now.
     '''
-    self.tasks.append((fn, args, kwargs))
     self.lock.acquire()
-    self.run()
-    self.lock.release()
+    try:
+      if self.max_queue and len(self.tasks) >= self.max_queue:
+        self.rejected += 1
+        raise QueueFullError('Task queue full: %s tasks waiting' % len(self.tasks))
+      self.tasks.append((fn, args, kwargs))
+      self.submitted += 1
+      self.peak_queued = max(self.peak_queued, len(self.tasks))
+      self.run()
+    finally:
+      self.lock.release()
+
+  def submit(self, fn, *args, **kwargs):
+    '''Like ``add_task`` but returns a ``toto.futures.Future`` that will resolve with the
+    return value of ``fn`` (or the exception it raises). If the queue was created with an
+    ``io_loop``, the future's callbacks will run on that ``IOLoop``.
+    '''
+    future = Future(self.io_loop)
+    def run_task():
+      if future.cancelled():
+        return
+      try:
+        result = fn(*args, **kwargs)
+      except Exception as e:
+        future.set_exc_info(sys.exc_info())
+      else:
+        future.set_result(result)
+    self.add_task(run_task)
+    return future
 
   def run(self):
     '''Start processing jobs in the queue. You should not need
@@ -51,7 +90,13 @@ class TaskQueue():
           logging.error(traceback.format_exc())
         finally:
           self.lock.release()
-        task[0](*task[1], **task[2])
+        try:
+          task[0](*task[1], **task[2])
+        except Exception as e:
+          logging.error(traceback.format_exc())
+        self.lock.acquire()
+        self.completed += 1
+        self.lock.release()
     thread = Thread(target=task_loop)
     thread.daemon = True
     self.threads.add(thread)
@@ -62,8 +107,16 @@ class TaskQueue():
     queued tasks/'''
     return len(self.threads) + len(self.tasks)
 
+  def stats(self):
+    '''Returns a dictionary describing the current state of the queue: the number of
+    active threads and waiting tasks, the configured limits, the number of submitted,
+    completed and rejected tasks and the largest number of tasks that have been waiting at once.
+    '''
+    return {'threads': len(self.threads), 'thread_count': self.thread_count, 'queued': len(self.tasks), 'max_queue': self.max_queue,
+        'submitted': self.submitted, 'completed': self.completed, 'rejected': self.rejected, 'peak_queued': self.peak_queued}
+
   @classmethod
-  def instance(cls, name, thread_count=1):
+  def instance(cls, name, thread_count=1, io_loop=None, max_queue=0):
     '''A convenience method for accessing shared instances of ``TaskQueue``.
     If ``name`` references an existing instance created with this method,
     that instance will be returned. Otherwise, a new ``TaskQueue`` will be
@@ -74,5 +127,11 @@ class TaskQueue():
     try:
       return cls._task_queues[name]
     except KeyError:
-      cls._task_queues[name] = cls(thread_count)
+      cls._task_queues[name] = cls(thread_count, io_loop, max_queue)
       return cls._task_queues[name]
+
+  @classmethod
+  def instance_stats(cls):
+    '''Returns a dictionary mapping the name of each shared instance to its ``stats()``.
+    '''
+    return {name: queue.stats() for name, queue in getattr(cls, '_task_queues', {}).iteritems()}
@@ -5,13 +5,17 @@ import tornado
 from tornado.options import define, options
 import logging
 import zlib
-import cPickle as pickle
+from toto.serialization import get_codec
 import sys
 import time
-from threading import Thread
+from threading import Thread, local
+from collections import OrderedDict, deque
+from toto.tasks import TaskQueue
+from toto.futures import Future
 from multiprocessing import Process, cpu_count
 from toto.service import TotoService, process_count, pid_path
 from toto.dbconnection import configured_connection
+from toto.dispatch import DispatchTable
 
 define("method_module", default='methods', help="The root module to use for method lookup")
 define("remote_event_receivers", type=str, help="A comma separated list of remote event address that this event manager should connect to. e.g.: 'tcp://192.168.1.2:8889'", multiple=True)
@@ -19,10 +23,85 @@ define("event_init_module", default=None, type=str, help="If defined, this modul
 define("startup_function", default=None, type=str, help="An optional function to run on startup - e.g. module.function. The function will be called for each worker process after it is configured and before it starts listening for tasks with the named parameters worker and db_connection.")
 define("worker_address", default="tcp://*:55555", help="The service will bind to this address with a zmq PULL socket and listen for incoming tasks. Tasks will be load balanced to all workers. If this is set to an empty string, workers will connect directly to worker_socket_address.")
 define("worker_socket_address", default="ipc:///tmp/workerservice.sock", help="The load balancer will use this address to coordinate tasks between local workers")
+define("worker_lanes", type=str, help="A comma separated list of named task lanes as name:weight or name:weight:address, e.g. 'interactive:3,bulk:1'. Each lane gets a dedicated pool of worker processes in proportion to its weight (at least one each, so processes must be at least the number of lanes) and tasks are routed to the lane passed to WorkerConnection.invoke(), or the first lane if none is given. Lanes without an address listen on worker_socket_address with a '.name' suffix. If not set, tasks are load balanced to all workers")
 define("control_socket_address", default="ipc:///tmp/workercontrol.sock", help="Workers will subscribe to messages on this socket and listen for control commands. If this is an empty string, the command option will have no effect")
 define("command", type=str, metavar='status|shutdown', help="Specify a command to send to running workers on the control socket")
 define("compression_module", type=str, help="The module to use for compressing and decompressing messages. The module must have 'decompress' and 'compress' methods. If not specified, no compression will be used. You can also set worker.compress and worker.decompress in your startup method for increased flexibility")
-define("serialization_module", type=str, help="The module to use for serializing and deserializing messages. The module must have 'dumps' and 'loads' methods. If not specified, cPickle will be used. You can also set worker.dumps and worker.loads in your startup method for increased flexibility")
+define("worker_concurrency", default=0, help="If greater than zero, each worker process will run up to this many tasks at once on a thread pool instead of one at a time. In this mode, @asynchronous worker methods that return a toto.futures.Future reply with its result")
+define("worker_reply_cache_size", default=1000, help="Each worker process will remember its replies to this many recent tasks and send the stored reply instead of running a task again if it is retried")
+define("serialization_module", type=str, help="The codec (see toto.serialization) or module to use for serializing and deserializing messages. Modules must have 'dumps' and 'loads' methods. If not specified, pickle will be used. You can also set worker.dumps and worker.loads in your startup method for increased flexibility")
+
+def configured_lanes():
+  '''Returns the lanes configured with the ``worker_lanes`` option as a list of ``(name, weight, address)`` tuples,
+  or an empty list if no lanes are configured.
+  '''
+  lanes = []
+  for lane in (options.worker_lanes or '').split(','):
+    if not lane.strip():
+      continue
+    parts = lane.strip().split(':', 2)
+    name = parts[0]
+    weight = len(parts) > 1 and int(parts[1]) or 1
+    address = len(parts) > 2 and parts[2] or '%s.%s' % (options.worker_socket_address, name)
+    lanes.append((name, weight, address))
+  return lanes
+
+def lane_assignments(lanes, count):
+  '''Divides ``count`` worker processes between ``lanes`` in proportion to their weights and returns the lane for each
+  process. Every lane gets at least one process if there are enough to go around.
+  '''
+  counts = [0] * len(lanes)
+  for i in xrange(min(count, len(lanes))):
+    counts[i] = 1
+  total = float(sum(lane[1] for lane in lanes))
+  for i in xrange(count - sum(counts)):
+    deficits = [count * lane[1] / total - n for lane, n in zip(lanes, counts)]
+    counts[deficits.index(max(deficits))] += 1
+  return [lane for lane, n in zip(lanes, counts) for i in xrange(n)]
+
+def lane_balancer(address, lanes):
+  '''Accepts tasks on ``address`` and routes each one to the worker pool for the lane named in its last frame. Tasks
+  for unknown lanes, or without a lane, go to the first lane. Each lane is a separate queue, so a backlog of tasks in
+  one lane does not delay tasks in the others. Tasks are held by the balancer until their lane has a worker that can
+  accept them.
+  '''
+  context = zmq.Context()
+  frontend = context.socket(zmq.ROUTER)
+  frontend.bind(address)
+  backends = {}
+  pending = {}
+  poller = zmq.Poller()
+  poller.register(frontend, zmq.POLLIN)
+  for name, weight, lane_address in lanes:
+    backend = backends[name] = context.socket(zmq.DEALER)
+    backend.bind(lane_address)
+    pending[backend] = deque()
+    poller.register(backend, zmq.POLLIN)
+  default = backends[lanes[0][0]]
+
+  def send_pending(backend):
+    queue = pending[backend]
+    try:
+      while queue:
+        backend.send_multipart(queue[0], zmq.NOBLOCK)
+        queue.popleft()
+    except zmq.Again:
+      pass
+    poller.register(backend, queue and zmq.POLLIN | zmq.POLLOUT or zmq.POLLIN)
+
+  while True:
+    for socket, event in poller.poll():
+      if socket is frontend:
+        # frames are [client, '', message_id, message] with an optional lane name
+        frames = socket.recv_multipart()
+        backend = len(frames) > 4 and backends.get(frames[-1]) or default
+        pending[backend].append(frames)
+        send_pending(backend)
+        continue
+      if event & zmq.POLLIN:
+        frontend.send_multipart(socket.recv_multipart())
+      if event & zmq.POLLOUT:
+        send_pending(socket)
 
 class TotoWorkerService(TotoService):
 
@@ -55,7 +134,18 @@ class TotoWorkerService(TotoService):
 
   def prepare(self):
     self.balancer = None
-    if options.worker_address:
+    self.lanes = configured_lanes()
+    count = options.processes if options.processes >= 0 else cpu_count()
+    if self.lanes and 0 < count < len(self.lanes):
+      raise Exception('%s worker process%s cannot serve %s lanes, set processes to at least %s' % (count, count > 1 and 'es' or '', len(self.lanes), len(self.lanes)))
+    if self.lanes and options.worker_address:
+      self.balancer = Process(target=lane_balancer, args=(options.worker_address, self.lanes))
+      self.balancer.daemon = True
+      self.balancer.start()
+      if options.daemon:
+        with open(pid_path(0), 'wb') as f:
+          f.write(str(self.balancer.pid))
+    elif options.worker_address:
       self.balancer = ProcessDevice(zmq.QUEUE, zmq.ROUTER, zmq.DEALER)
       self.balancer.daemon = True
       self.balancer.bind_in(options.worker_address)
@@ -66,7 +156,10 @@ class TotoWorkerService(TotoService):
       if options.daemon:
         with open(pid_path(0), 'wb') as f:
           f.write(str(self.balancer.launcher.pid))
-    count = options.processes if options.processes >= 0 else cpu_count()
+    if self.lanes:
+      assignments = [lane[0] for lane in lane_assignments(self.lanes, count)]
+      for name, weight, address in self.lanes:
+        print 'Lane "%s": %s worker process%s. Routing to "%s"' % (name, assignments.count(name), assignments.count(name) != 1 and 'es' or '', address)
     if count == 0:
       print 'Starting load balancer. Listening on "%s". Routing to "%s"' % (options.worker_address, options.worker_socket_address)
     else:
@@ -84,9 +177,12 @@ class TotoWorkerService(TotoService):
       init_module = self.__event_init
       if init_module:
         init_module.invoke(event_manager)
-    serialization = options.serialization_module and __import__(options.serialization_module) or pickle
+    serialization = get_codec(options.serialization_module or 'pickle')
     compression = options.compression_module and __import__(options.compression_module)
-    worker = TotoWorker(self.__method_module, options.worker_socket_address, db_connection, compression, serialization)
+    socket_address = options.worker_socket_address
+    if self.lanes:
+      socket_address = lane_assignments(self.lanes, process_count())[self.service_id][2]
+    worker = TotoWorker(self.__method_module, socket_address, db_connection, compression, serialization)
     if options.startup_function:
       startup_path = options.startup_function.rsplit('.')
       __import__(startup_path[0]).__dict__[startup_path[1]](worker=worker, db_connection=db_connection)
@@ -111,14 +207,19 @@ class TotoWorker():
     self.context = zmq.Context()
     self.socket_address = socket_address
     self.method_module = method_module
+    self.dispatch_table = DispatchTable(method_module)
     self.db_connection = db_connection
     self.db = db_connection and db_connection.db or None
     self.status = 'Initialized'
     self.running = False
+    self.reply_cache_size = options.worker_reply_cache_size
+    self.concurrency = options.worker_concurrency
+    self.__replies = OrderedDict()
     self.compress = compression and compression.compress or (lambda x: x)
     self.decompress = compression and compression.decompress or (lambda x: x)
-    self.loads = serialization and serialization.loads or pickle.loads
-    self.dumps = serialization and serialization.dumps or pickle.dumps
+    serialization = serialization or get_codec('pickle')
+    self.loads = serialization.loads
+    self.dumps = serialization.dumps
     if options.debug:
       from traceback import format_exc
       def log_error(self, e):
@@ -157,9 +258,142 @@ class TotoWorker():
       thread.daemon = True
       thread.start()
 
+  def __invoke_batch(self, tasks):
+    # Asynchronous methods are deferred until the results have been sent, as they are for single tasks
+    results = []
+    deferred = []
+    for task in tasks:
+      try:
+        (method, invoke, asynchronous) = self.dispatch_table.get(task['method'])
+        if asynchronous:
+          deferred.append((invoke, task['parameters']))
+          results.append(None)
+        else:
+          results.append(invoke(self, task['parameters']))
+      except Exception as e:
+        results.append(self.log_error(e))
+    return results, deferred
+
+  def __remember(self, reply):
+    if self.reply_cache_size:
+      self.__replies[reply[0]] = reply
+      while len(self.__replies) > self.reply_cache_size:
+        self.__replies.popitem(False)
+
+  def __reply(self, socket, reply):
+    self.__remember(reply)
+    socket.send_multipart(reply)
+
+  def __start_concurrent(self):
+    # A DEALER socket keeps the routing envelope of each task so replies can be sent in any order. Replies from pool
+    # threads and futures are passed back to this thread through an inproc socket, as ZMQ sockets are not thread safe.
+    socket = self.context.socket(zmq.DEALER)
+    socket.connect(self.socket_address)
+    reply_address = 'inproc://toto.worker.%s' % id(self)
+    replies = self.context.socket(zmq.PULL)
+    replies.bind(reply_address)
+    reply_sockets = local()
+    pool = TaskQueue.instance('toto.worker', self.concurrency)
+    in_flight = set()
+
+    def send_reply(envelope, reply):
+      push = getattr(reply_sockets, 'socket', None)
+      if push is None:
+        push = reply_sockets.socket = self.context.socket(zmq.PUSH)
+        push.connect(reply_address)
+      push.send_multipart(envelope + list(reply))
+
+    def reply_with(envelope, message_id, deferred=()):
+      def done(future):
+        try:
+          response = future.result()
+        except Exception as e:
+          response = self.log_error(e)
+        send_reply(envelope, (message_id, self.compress(self.dumps(response))))
+        for invoke, parameters in deferred:
+          try:
+            invoke(self, parameters)
+          except Exception as e:
+            self.log_error(e)
+      return done
+
+    def receive_task(frames):
+      delimiter = frames.index('')
+      envelope, message_id = frames[:delimiter + 1], frames[delimiter + 1]
+      reply = self.__replies.get(message_id)
+      if reply:
+        logging.info('Received duplicate Task %s' % message_id)
+        socket.send_multipart(envelope + list(reply))
+        return
+      if message_id in in_flight:
+        return
+      in_flight.add(message_id)
+      try:
+        data = self.loads(self.decompress(frames[delimiter + 2]))
+        if 'batch' in data:
+          logging.info('Received Batch %s: %s tasks' % (message_id, len(data['batch'])))
+          deferred = []
+          def run_batch():
+            results, asynchronous_tasks = self.__invoke_batch(data['batch'])
+            deferred.extend(asynchronous_tasks)
+            return results
+          pool.submit(run_batch).add_done_callback(reply_with(envelope, message_id, deferred))
+          return
+        logging.info('Received Task %s: %s' % (message_id, data['method']))
+        (method, invoke, asynchronous) = self.dispatch_table.get(data['method'])
+        if not asynchronous:
+          pool.submit(invoke, self, data['parameters']).add_done_callback(reply_with(envelope, message_id))
+          return
+        # Asynchronous methods run on the pool so they cannot block this thread. Those that return a Future reply with
+        # its result, the rest are acknowledged as soon as they return
+        def run_asynchronous(parameters):
+          try:
+            result = invoke(self, parameters)
+            if isinstance(result, Future):
+              result.add_done_callback(reply_with(envelope, message_id))
+            else:
+              send_reply(envelope, (message_id,))
+          except Exception as e:
+            send_reply(envelope, (message_id, self.compress(self.dumps(self.log_error(e)))))
+        pool.submit(run_asynchronous, data['parameters'])
+      except Exception as e:
+        send_reply(envelope, (message_id, self.compress(self.dumps(self.log_error(e)))))
+
+    poller = zmq.Poller()
+    poller.register(replies, zmq.POLLIN)
+    accepting = False
+    while self.running:
+      try:
+        self.status = in_flight and 'Working' or 'Listening'
+        if accepting != (len(in_flight) < self.concurrency):
+          accepting = not accepting
+          if accepting:
+            poller.register(socket, zmq.POLLIN)
+          else:
+            poller.unregister(socket)
+        ready = dict(poller.poll(1000))
+        if replies in ready:
+          while replies.poll(0):
+            frames = replies.recv_multipart()
+            delimiter = frames.index('')
+            reply = frames[delimiter + 1:]
+            self.__remember(reply)
+            in_flight.discard(reply[0])
+            socket.send_multipart(frames)
+        if socket in ready:
+          while len(in_flight) < self.concurrency and socket.poll(0):
+            receive_task(socket.recv_multipart())
+      except Exception as e:
+        self.log_error(e)
+
   def start(self):
     self.running = True
     self.__monitor_control()
+    if self.concurrency > 0:
+      self.__start_concurrent()
+      self.status = 'Finished'
+      self.log_status()
+      return
     socket = self.context.socket(zmq.REP)
     socket.connect(self.socket_address)
     pending_reply = False
@@ -169,25 +403,41 @@ class TotoWorker():
         message = socket.recv_multipart()
         pending_reply = True
         message_id = message[0]
+        reply = self.__replies.get(message_id)
+        if reply:
+          logging.info('Received duplicate Task %s' % message_id)
+          socket.send_multipart(reply)
+          pending_reply = False
+          continue
         data = self.loads(self.decompress(message[1]))
+        if 'batch' in data:
+          logging.info('Received Batch %s: %s tasks' % (message_id, len(data['batch'])))
+          self.status = 'Working'
+          results, deferred = self.__invoke_batch(data['batch'])
+          self.__reply(socket, (message_id, self.compress(self.dumps(results))))
+          pending_reply = False
+          for invoke, parameters in deferred:
+            try:
+              invoke(self, parameters)
+            except Exception as e:
+              self.log_error(e)
+          continue
         logging.info('Received Task %s: %s' % (message_id, data['method']))
-        method = self.method_module
-        for i in data['method'].split('.'):
-          method = getattr(method, i)
-        if hasattr(method.invoke, 'asynchronous'):
-          socket.send_multipart((message_id,))
+        (method, invoke, asynchronous) = self.dispatch_table.get(data['method'])
+        if asynchronous:
+          self.__reply(socket, (message_id,))
           pending_reply = False
           self.status = 'Working'
-          method.invoke(self, data['parameters'])
+          invoke(self, data['parameters'])
         else:
           self.status = 'Working'
-          response = method.invoke(self, data['parameters'])
-          socket.send_multipart((message_id, self.compress(self.dumps(response))))
+          response = invoke(self, data['parameters'])
+          self.__reply(socket, (message_id, self.compress(self.dumps(response))))
           pending_reply = False
       except Exception as e:
         err_string = self.log_error(e)
         if pending_reply:
-          socket.send_multipart((message_id, self.compress(self.dumps(err_string))))
+          self.__reply(socket, (message_id, self.compress(self.dumps(err_string))))
 
     self.status = 'Finished'
     self.log_status()
@@ -1,25 +1,42 @@
 import toto
 import zmq
-import cPickle as pickle
+from toto.serialization import get_codec
 import zlib
 import logging
 from threading import Thread
 from tornado.options import options, define
 from collections import deque
-from zmq.eventloop.ioloop import ZMQPoller, IOLoop, PeriodicCallback
+from zmq.eventloop.ioloop import ZMQPoller, IOLoop
 from zmq.eventloop.zmqstream import ZMQStream
 from time import time
+from random import uniform
+from heapq import heappush, heappop, heapify
+from toto.futures import Future, TimeoutError
+from toto.exceptions import *
+import tornado.ioloop
 from uuid import uuid4
 from traceback import format_exc
 
 define("worker_compression_module", type=str, help="The module to use for compressing and decompressing messages to workers. The module must have 'decompress' and 'compress' methods. If not specified, no compression will be used. Only the default instance will be affected")
-define("worker_serialization_module", type=str, help="The module to use for serializing and deserializing messages to workers. The module must have 'dumps' and 'loads' methods. If not specified, cPickle will be used. Only the default instance will be affected")
+define("worker_serialization_module", type=str, help="The codec (see toto.serialization) or module to use for serializing and deserializing messages to workers. Modules must have 'dumps' and 'loads' methods. If not specified, pickle will be used. Only the default instance will be affected")
 define("worker_retry_ms", default=10000, help="The default worker (instance()) will wait at least this many milliseconds before retrying a request")
+define("worker_max_in_flight", default=10000, help="The default worker (instance()) will refuse new tasks with ERROR_SERVER_BUSY while this many tasks are waiting for a response, or zero for no limit")
+define("worker_max_attempts", default=10, help="The default worker (instance()) will give up on a task after sending it this many times, or zero to retry forever")
+define("worker_max_retry_ms", default=120000, help="The default worker (instance()) doubles the delay before each retry of a task up to this many milliseconds")
 define("worker_address", default='', help="This is the address that toto.workerconnection.invoke(method, params) will send tasks too (As specified in the worker conf file)")
 
 class WorkerConnection(object):
+  '''Sends tasks to the workers at ``address``. Tasks without a response are sent again after ``retry_ms``
+  milliseconds, doubling the delay (plus up to 50% random jitter) on each attempt up to ``max_retry_ms``. After
+  ``max_attempts`` sends a task fails. Set either to zero to disable the limit.
 
-  def __init__(self, address, retry_ms=10000, compression=None, serialization=None):
+  While ``max_in_flight`` tasks are waiting for a response, new tasks are refused with a ``TotoException`` with code
+  ``ERROR_SERVER_BUSY`` so callers can shed load. Use ``full()`` to check before sending.
+
+  If the workers are configured with ``worker_lanes``, pass ``lane`` to send a task to a lane's dedicated worker pool.
+  '''
+
+  def __init__(self, address, retry_ms=10000, compression=None, serialization=None, max_in_flight=10000, max_attempts=10, max_retry_ms=120000):
     self.address = address
     self.message_address = 'inproc://WorkerConnection%s' % id(self)
     self.__context = zmq.Context()
@@ -27,33 +44,133 @@ class WorkerConnection(object):
     self.__queue_socket.bind(self.message_address)
     self.__thread = None
     self.__retry_ms = retry_ms
+    self.max_in_flight = max_in_flight
+    self.max_attempts = max_attempts
+    self.max_retry_ms = max_retry_ms
+    self.__in_flight = set()
     self.__callbacks = {}
+    self.__errbacks = {}
     self.__queued_messages = {}
     self.__message_timeouts = {}
     self.__ioloop = None
-    self.loads = serialization and serialization.loads or pickle.loads
-    self.dumps = serialization and serialization.dumps or pickle.dumps
+    serialization = serialization or get_codec('pickle')
+    self.loads = serialization.loads
+    self.dumps = serialization.dumps
     self.compress = compression and compression.compress or (lambda x: x)
     self.decompress = compression and compression.decompress or (lambda x: x)
   
-  def invoke(self, method, parameters, callback=None, retry_ms=0):
-    self._queue_message(self.compress(self.dumps({'method': method, 'parameters': parameters})), callback, retry_ms)
+  def invoke(self, method, parameters, callback=None, retry_ms=0, future=False, timeout_ms=0, lane=None):
+    '''Send a task to run ``method`` with ``parameters`` on a worker. ``callback`` will be called with the response on
+    the connection's thread. The task is sent again if no response is received within ``retry_ms`` milliseconds
+    (the connection's ``retry_ms`` by default). If the task fails after ``max_attempts``, ``callback`` is called with a
+    ``TotoException`` with code ``ERROR_TIMEOUT`` instead of a response.
+
+    If ``future`` is ``True``, a ``toto.futures.Future`` is returned that resolves with the response on Tornado's main
+    ``IOLoop`` and ``callback``, if given, is also called there with the response. If ``timeout_ms`` is set, the future fails with ``toto.futures.TimeoutError`` if no response is received
+    in time, or with the ``TotoException`` described above. Cancelling the future or a timeout stops the task from being retried, but a worker that has already
+    received it may still run it. Use ``toto.futures.gather()`` to wait for several tasks at once.
+
+    ``lane`` names the worker lane (see the worker's ``worker_lanes`` option) that will run the task. Tasks without a
+    lane, or for an unknown lane, run in the first lane.
+    '''
+    message = self.compress(self.dumps({'method': method, 'parameters': parameters}))
+    if future:
+      return self._queue_future(message, callback, retry_ms, timeout_ms, lane)
+    self._queue_message(message, callback, retry_ms, lane=lane)
+
+  def invoke_many(self, tasks, retry_ms=0, lane=None):
+    '''Send ``tasks``, a list of ``(method, parameters)`` or ``(method, parameters, callback)`` tuples, to a worker as
+    a single message. The tasks are serialized together and run in order by one worker, which replies with all of the
+    results at once. Each task's ``callback`` is called with its result. If the batch is retried, every task in it
+    will be run again. The batch is sent to ``lane`` if given.
+    '''
+    callbacks = [len(task) > 2 and task[2] or None for task in tasks]
+    def receive_results(results):
+      if not isinstance(results, list):
+        results = [results] * len(callbacks)
+      for callback, result in zip(callbacks, results):
+        if callback:
+          try:
+            callback(result)
+          except Exception as e:
+            self.log_error(e)
+    batch = [{'method': task[0], 'parameters': task[1]} for task in tasks]
+    self._queue_message(self.compress(self.dumps({'batch': batch})), any(callbacks) and receive_results or None, retry_ms, lane=lane)
   
   def __len__(self):
-    return len(self.__queued_messages)
+    return len(self.__in_flight)
+
+  def full(self):
+    '''Returns ``True`` if ``max_in_flight`` tasks are waiting for a response and new tasks will be refused.
+    '''
+    return bool(self.max_in_flight) and len(self.__in_flight) >= self.max_in_flight
 
   def __getattr__(self, path):
     return WorkerInvocation(path, self)
 
-  def _queue_message(self, message, callback=None, retry_ms=0):
+  def _queue_message(self, message, callback=None, retry_ms=0, errback=None, lane=None):
+    if self.full():
+      raise TotoException(ERROR_SERVER_BUSY, 'Too many worker tasks in flight')
     if not self.__ioloop:
       self.start()
     message_id = str(uuid4())
+    self.__in_flight.add(message_id)
     if callback:
       self.__callbacks[message_id] = callback
+    if errback:
+      self.__errbacks[message_id] = errback
     if retry_ms > 0:
       self.__message_timeouts[message_id] = retry_ms
-    self.__queue_socket.send_multipart(('', message_id, message))
+    self.__queue_socket.send_multipart(lane and ('', message_id, message, lane) or ('', message_id, message))
+    return message_id
+
+  def _queue_future(self, message, callback=None, retry_ms=0, timeout_ms=0, lane=None):
+    io_loop = tornado.ioloop.IOLoop.instance()
+    future = Future(io_loop)
+    message_id = self._queue_message(message, future.set_result, retry_ms, future.set_exception, lane)
+    timeout = []
+    # done and add_timeout both run on io_loop, so the timeout is either never added or removed here
+    def done(f):
+      if timeout:
+        io_loop.remove_timeout(timeout[0])
+      if f.exc_info():
+        self._discard_message(message_id)
+      elif callback:
+        try:
+          callback(f.result())
+        except Exception as e:
+          self.log_error(e)
+    future.add_done_callback(done)
+    if timeout_ms:
+      def add_timeout():
+        if not future.done():
+          timeout.append(io_loop.add_timeout(time() + timeout_ms / 1000.0, lambda: future.set_exception(TimeoutError('No response from worker after %sms' % timeout_ms))))
+      io_loop.add_callback(add_timeout)
+    return future
+
+  def _discard_message(self, message_id):
+    self.__in_flight.discard(message_id)
+    self.__callbacks.pop(message_id, None)
+    self.__errbacks.pop(message_id, None)
+    self.__message_timeouts.pop(message_id, None)
+    self.__queued_messages.pop(message_id, None)
+
+  def _fail_message(self, message_id, error):
+    callback = self.__errbacks.get(message_id) or self.__callbacks.get(message_id)
+    self._discard_message(message_id)
+    if not callback:
+      self.log_error(error)
+      return
+    try:
+      callback(error)
+    except Exception as e:
+      self.log_error(e)
+
+  def _retry_delay(self, retry_ms, attempts):
+    delay = retry_ms * 2 ** (attempts - 1)
+    if self.max_retry_ms:
+      delay = min(delay, self.max_retry_ms)
+    return delay * uniform(1.0, 1.5)
   
   def log_error(self, error):
     logging.error(repr(error))
@@ -69,30 +186,66 @@ class WorkerConnection(object):
       worker_stream = ZMQStream(worker_socket, self.__ioloop)
 
       def receive_response(message):
+        self.__in_flight.discard(message[1])
         self.__queued_messages.pop(message[1], None)
         self.__message_timeouts.pop(message[1], None)
+        self.__errbacks.pop(message[1], None)
         callback = self.__callbacks.pop(message[1], None)
         if callback:
           try:
-            callback(self.loads(self.decompress(message[2])))
+            callback(self.loads(self.decompress(message[2])) if len(message) > 2 else None)
           except Exception as e:
             self.log_error(e)
       worker_stream.on_recv(receive_response)
 
-      def queue_message(message):
-        self.__queued_messages[message[1]] = (time() * 1000, message)
+      def send_message(message):
         try:
           worker_stream.send_multipart(message)
         except Exception as e:
           self.log_error(e)
+
+      # Retry deadlines are kept in a heap of (deadline, message_id) and a single timeout is scheduled for the earliest
+      # one. Entries for answered or rescheduled messages are skipped when they reach the top of the heap.
+      deadlines = []
+      scheduled = [None, None]
+
+      def schedule():
+        if len(deadlines) > 2 * len(self.__queued_messages) + 1000:
+          deadlines[:] = [(entry[0], message_id) for message_id, entry in self.__queued_messages.items()]
+          heapify(deadlines)
+        if not deadlines or (scheduled[1] and scheduled[0] <= deadlines[0][0]):
+          return
+        if scheduled[1]:
+          self.__ioloop.remove_timeout(scheduled[1])
+        scheduled[0] = deadlines[0][0]
+        scheduled[1] = self.__ioloop.add_timeout(scheduled[0] / 1000.0, requeue_message)
+
+      def queue_message(message):
+        if message[1] not in self.__in_flight:
+          return
+        retry_ms = self.__message_timeouts.pop(message[1], self.__retry_ms)
+        entry = self.__queued_messages[message[1]] = [time() * 1000 + self._retry_delay(retry_ms, 1), message, 1, retry_ms]
+        heappush(deadlines, (entry[0], message[1]))
+        schedule()
+        send_message(message)
       queue_stream.on_recv(queue_message)
 
       def requeue_message():
+        scheduled[1] = None
         now = time() * 1000
-        for message in (item[1] for item in self.__queued_messages.itervalues() if item[0] + self.__message_timeouts.get(item[1][1], self.__retry_ms) < now):
-          queue_message(message)
-      requeue_callback = PeriodicCallback(requeue_message, self.__retry_ms, io_loop = self.__ioloop)
-      requeue_callback.start()
+        while deadlines and deadlines[0][0] <= now:
+          deadline, message_id = heappop(deadlines)
+          entry = self.__queued_messages.get(message_id)
+          if not entry or entry[0] != deadline:
+            continue
+          if self.max_attempts and entry[2] >= self.max_attempts:
+            self._fail_message(message_id, TotoException(ERROR_TIMEOUT, 'No response from worker after %s attempts' % entry[2]))
+            continue
+          entry[2] += 1
+          entry[0] = now + self._retry_delay(entry[3], entry[2])
+          heappush(deadlines, (entry[0], message_id))
+          send_message(entry[1])
+        schedule()
 
       self.__ioloop.start()
       self.__thread = None
@@ -118,7 +271,7 @@ class WorkerConnection(object):
   @classmethod
   def instance(cls):
     if not hasattr(cls, '_instance'):
-      cls._instance = cls(options.worker_address, retry_ms=options.worker_retry_ms, compression=options.worker_compression_module and __import__(options.worker_compression_module), serialization=options.worker_serialization_module and __import__(options.worker_serialization_module))
+      cls._instance = cls(options.worker_address, retry_ms=options.worker_retry_ms, compression=options.worker_compression_module and __import__(options.worker_compression_module), serialization=options.worker_serialization_module and get_codec(options.worker_serialization_module), max_in_flight=options.worker_max_in_flight, max_attempts=options.worker_max_attempts, max_retry_ms=options.worker_max_retry_ms)
     return cls._instance
 
 class WorkerInvocation(object):
@@ -127,8 +280,8 @@ class WorkerInvocation(object):
     self._path = path
     self._connection = connection
 
-  def __call__(self, parameters, callback=None, retry_ms=0):
-    self._connection.invoke(self._path, parameters, callback, retry_ms)
+  def __call__(self, parameters, callback=None, retry_ms=0, future=False, timeout_ms=0, lane=None):
+    return self._connection.invoke(self._path, parameters, callback, retry_ms, future, timeout_ms, lane)
 
   def __getattr__(self, path):
     return getattr(self._connection, self._path + '.' + path)